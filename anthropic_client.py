@@ -0,0 +1,97 @@
+"""
+Process-wide Anthropic client.
+Building anthropic.Anthropic() allocates a fresh HTTP connection pool, so the
+classifier, drafter, and background setup share one lazily-created instance.
+Also parses JSON out of model replies and trims text to a token budget.
+"""
+
+import json
+import os
+import random
+import re
+import threading
+from typing import Optional
+
+import anthropic
+
+_client: anthropic.Anthropic = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> anthropic.Anthropic:
+    """Return the shared client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    return _client
+
+
+# Status codes worth retrying: rate limit, transient server errors, overloaded
+RETRYABLE_STATUS = {429, 500, 502, 503, 529}
+
+
+def retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying a failed request, or None if the error
+    isn't transient. Honors Retry-After when present, otherwise backs off
+    exponentially from 2s; jitter keeps concurrent workers from retrying
+    in lockstep.
+    """
+    if isinstance(error, anthropic.APIStatusError):
+        if error.status_code not in RETRYABLE_STATUS:
+            return None
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            base = float(retry_after) if retry_after else 2.0 * 2 ** attempt
+        except ValueError:
+            base = 2.0 * 2 ** attempt
+    elif isinstance(error, anthropic.APIConnectionError):
+        base = 2.0 * 2 ** attempt
+    else:
+        return None
+    # Cap before adding jitter so the total wait never exceeds 60s * 1.5
+    base = min(60.0, base)
+    return base + random.uniform(0, base / 2)
+
+
+_decoder = json.JSONDecoder()
+
+
+def parse_json(text: str):
+    """
+    Decode the first JSON object/array in a model reply, skipping any
+    markdown fences or prose around it. Raises json.JSONDecodeError.
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise json.JSONDecodeError("No JSON value found", text, 0)
+    value, _ = _decoder.raw_decode(text, min(starts))
+    return value
+
+
+# Rough chars-per-token for English prose; turns a token budget into a
+# character budget without a tokenizer round-trip
+CHARS_PER_TOKEN = 4
+
+# Unbroken runs this long (base64 blobs, encoded payloads) tokenize at close
+# to one token per character and carry nothing the model needs. Runs that
+# start with a URL are kept: a meeting or share link may be the very thing
+# the reply has to reference.
+_BLOB_RE = re.compile(r"(?<!\S)(?![<(\[\"']?https?://)\S{100,}")
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Trim text to roughly max_tokens, ending on a word boundary. Long
+    unbroken runs are collapsed first so they don't eat the budget.
+    """
+    text = _BLOB_RE.sub("[…]", text)
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    cut = max(head.rfind(" "), head.rfind("\n"))
+    # Only back up to whitespace if it doesn't throw away much of the budget
+    return head[:cut] if cut > limit * 0.8 else head
@@ -6,12 +6,15 @@ Client credentials come from GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET env vars.
 """
 
 import os
+import re
 import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 from google.auth import _helpers as _ga_helpers
 from google.auth.transport.requests import Request
+from google.oauth2 import id_token
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
@@ -63,6 +66,17 @@ def _client_config() -> dict:
 _token_locks: dict[str, threading.Lock] = {}
 _token_locks_mutex = threading.Lock()
 
+# In-process credential cache: user_id -> Credentials. The same object is
+# refreshed in place, so service objects built on top of it stay valid.
+_creds_cache: dict[str, Credentials] = {}
+
+# Last token dict persisted per user — lets us skip no-op DB writes
+_saved_tokens: dict[str, dict] = {}
+
+# Built API clients, per thread (httplib2 transports are not thread-safe):
+# (user_id, api) -> (service, credentials it was built with)
+_service_local = threading.local()
+
 
 def _get_token_lock(user_id: str) -> threading.Lock:
     with _token_locks_mutex:
@@ -97,58 +111,107 @@ def credentials_to_dict(creds: Credentials) -> dict:
     }
 
 
+def _persist_token(user_id: str, creds: Credentials) -> None:
+    """Save the token to the DB unless it matches what was last saved. Caller holds the user's lock."""
+    token_dict = credentials_to_dict(creds)
+    if _saved_tokens.get(user_id) == token_dict:
+        return
+    db.save_token(user_id, token_dict)
+    _saved_tokens[user_id] = token_dict
+
+
+def save_credentials(user_id: str, creds: Credentials) -> None:
+    """Persist freshly issued credentials (OAuth callback) and drop stale cached ones."""
+    with _get_token_lock(user_id):
+        _persist_token(user_id, creds)
+        _creds_cache.pop(user_id, None)
+
+
+def _needs_refresh(creds: Credentials, margin_seconds: int = 60) -> bool:
+    """True if the token is missing or expires within the next margin_seconds."""
+    # Check expiry ourselves with timezone-aware datetimes to avoid
+    # the naive-vs-aware comparison bug in older google-auth versions.
+    expiry = creds.expiry
+    if expiry is not None and expiry.tzinfo is None:
+        expiry = expiry.replace(tzinfo=timezone.utc)
+    token_expired = expiry is not None and datetime.now(timezone.utc) >= expiry - timedelta(seconds=margin_seconds)
+    return token_expired or not creds.token
+
+
+def _load_credentials(user_id: str) -> Credentials:
+    """Build a Credentials object from the token stored in the DB."""
+    token_dict = db.load_token(user_id)
+    if token_dict is None:
+        raise ValueError(f"No token found for user {user_id}")
+
+    client_id = os.environ["GOOGLE_CLIENT_ID"]
+    client_secret = os.environ["GOOGLE_CLIENT_SECRET"]
+
+    # Parse expiry
+    expiry = None
+    if token_dict.get("expiry"):
+        try:
+            expiry = datetime.fromisoformat(token_dict["expiry"])
+            if expiry.tzinfo is None:
+                expiry = expiry.replace(tzinfo=timezone.utc)
+        except ValueError:
+            expiry = None
+
+    return Credentials(
+        token=token_dict.get("token"),
+        refresh_token=token_dict.get("refresh_token"),
+        token_uri=token_dict.get("token_uri", "https://oauth2.googleapis.com/token"),
+        client_id=client_id,
+        client_secret=client_secret,
+        scopes=token_dict.get("scopes", SCOPES),
+        expiry=_compat_expiry(expiry),
+    )
+
+
 def get_credentials(user_id: str) -> Credentials:
     """
-    Load credentials for the given user from DB, refresh if expired, save back.
+    Return cached credentials for the user, loading from DB on first use.
+    Refreshes (and saves back) only when the token is within 60s of expiry.
     Raises ValueError if no token found.
     """
     lock = _get_token_lock(user_id)
     with lock:
-        token_dict = db.load_token(user_id)
-        if token_dict is None:
-            raise ValueError(f"No token found for user {user_id}")
-
-        client_id = os.environ["GOOGLE_CLIENT_ID"]
-        client_secret = os.environ["GOOGLE_CLIENT_SECRET"]
-
-        # Parse expiry
-        expiry = None
-        if token_dict.get("expiry"):
-            try:
-                expiry = datetime.fromisoformat(token_dict["expiry"])
-                if expiry.tzinfo is None:
-                    expiry = expiry.replace(tzinfo=timezone.utc)
-            except ValueError:
-                expiry = None
-
-        creds = Credentials(
-            token=token_dict.get("token"),
-            refresh_token=token_dict.get("refresh_token"),
-            token_uri=token_dict.get("token_uri", "https://oauth2.googleapis.com/token"),
-            client_id=client_id,
-            client_secret=client_secret,
-            scopes=token_dict.get("scopes", SCOPES),
-            expiry=_compat_expiry(expiry),
-        )
-
-        # Check expiry ourselves with timezone-aware datetimes to avoid
-        # the naive-vs-aware comparison bug in older google-auth versions.
-        expiry = creds.expiry
-        if expiry is not None and expiry.tzinfo is None:
-            expiry = expiry.replace(tzinfo=timezone.utc)
-        token_expired = expiry is not None and datetime.now(timezone.utc) >= expiry - timedelta(seconds=60)
-        token_missing = not creds.token
-
-        if token_expired or token_missing:
+        creds = _creds_cache.get(user_id)
+        if creds is None:
+            creds = _load_credentials(user_id)
+            _saved_tokens[user_id] = credentials_to_dict(creds)
+
+        if _needs_refresh(creds):
             if creds.refresh_token:
                 creds.refresh(Request())
-                db.save_token(user_id, credentials_to_dict(creds))
+                _persist_token(user_id, creds)
             else:
+                _creds_cache.pop(user_id, None)
                 raise ValueError(f"Token for user {user_id} is invalid and cannot be refreshed")
 
+        _creds_cache[user_id] = creds
         return creds
 
 
+def refresh_if_expiring(user_id: str, margin_seconds: int = 300) -> bool:
+    """
+    Refresh the user's token ahead of time if it expires within margin_seconds,
+    so polls and queue actions find it fresh. Returns True if it refreshed.
+    Tokens that can't be refreshed are left for get_credentials to report.
+    """
+    with _get_token_lock(user_id):
+        creds = _creds_cache.get(user_id)
+        if creds is None:
+            creds = _load_credentials(user_id)
+            _saved_tokens[user_id] = credentials_to_dict(creds)
+            _creds_cache[user_id] = creds
+        if not creds.refresh_token or not _needs_refresh(creds, margin_seconds):
+            return False
+        creds.refresh(Request())
+        _persist_token(user_id, creds)
+        return True
+
+
 def is_authorized(user_id: str) -> bool:
     """Check if a valid token exists for the given user."""
     try:
@@ -158,13 +221,71 @@ def is_authorized(user_id: str) -> bool:
         return False
 
 
+def _get_service(user_id: str, api: str, version: str):
+    """Return a cached API client for this thread, rebuilding if credentials changed."""
+    creds = get_credentials(user_id)
+    cache = getattr(_service_local, "services", None)
+    if cache is None:
+        cache = _service_local.services = {}
+    entry = cache.get((user_id, api))
+    if entry is not None and entry[1] is creds:
+        return entry[0]
+    service = build(api, version, credentials=creds, cache_discovery=False)
+    cache[(user_id, api)] = (service, creds)
+    return service
+
+
 def get_gmail_service(user_id: str):
-    return build("gmail", "v1", credentials=get_credentials(user_id))
+    return _get_service(user_id, "gmail", "v1")
 
 
 def get_calendar_service(user_id: str):
-    return build("calendar", "v3", credentials=get_credentials(user_id))
+    return _get_service(user_id, "calendar", "v3")
 
 
 def get_drive_service(user_id: str):
-    return build("drive", "v3", credentials=get_credentials(user_id))
+    return _get_service(user_id, "drive", "v3")
+
+
+# ── Sign-in id_token verification ─────────────────────────────────────────────
+
+# Fallback lifetime for Google's signing certs when the response has no max-age
+CERTS_DEFAULT_TTL_SECONDS = 3600
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class _CachingRequest:
+    """
+    google-auth transport that remembers successful GET responses until their
+    Cache-Control max-age runs out. verify_oauth2_token only GETs Google's
+    public signing certs, which rotate every few hours, so sign-ins reuse one
+    fetch (and one pooled HTTPS connection) instead of downloading them each time.
+    """
+
+    def __init__(self):
+        self._request = Request()
+        self._cache: dict[str, tuple[float, object]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method != "GET" or body is not None:
+            return self._request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        with self._lock:
+            entry = self._cache.get(url)
+        if entry is not None and time.monotonic() < entry[0]:
+            return entry[1]
+        response = self._request(url, method=method, headers=headers, timeout=timeout, **kwargs)
+        if response.status == 200:
+            match = _MAX_AGE_RE.search(response.headers.get("cache-control", ""))
+            ttl = int(match.group(1)) if match else CERTS_DEFAULT_TTL_SECONDS
+            with self._lock:
+                self._cache[url] = (time.monotonic() + ttl, response)
+        return response
+
+
+_certs_request = _CachingRequest()
+
+
+def verify_id_token(token: str) -> dict:
+    """Verify a Google sign-in id_token for our client and return its claims."""
+    return id_token.verify_oauth2_token(token, _certs_request, os.environ["GOOGLE_CLIENT_ID"])
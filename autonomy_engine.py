@@ -25,54 +25,91 @@ class RoutingDecision:
     reason: str
 
 
-def route(
-    classification: dict,
+def _decide(
     autonomy_level: int,
+    unknown_sender: bool,
     has_attachments_to_send: bool,
-    low_confidence_threshold: float = 0.70,
-    relationship_type: str = "unknown",
-) -> RoutingDecision:
-    """Determine the action to take for a classified email."""
-
-    needs_reply = classification.get("needs_reply", False)
-    sender_priority = classification.get("sender_priority", "unknown")
-    confidence = classification.get("confidence", 0.0)
-    is_critical = classification.get("is_critical", False)
-
+    non_personal_contact: bool,
+    is_low_confidence: bool,
+    is_critical: bool,
+) -> tuple[str, str]:
+    """
+    The routing rules, as (action, reason template). Reasons may reference
+    {confidence} and {relationship_type}, filled in by route().
+    """
     # --- Hard rules ---
-    if not needs_reply:
-        return RoutingDecision("skip", "No reply needed")
-
     # Unknown sender: always review regardless of level
-    if sender_priority == "unknown" or relationship_type == "unknown":
-        return RoutingDecision("review", "Unknown sender - always review")
+    if unknown_sender:
+        return "review", "Unknown sender - always review"
 
     # If we're attaching a file: always review
     if has_attachments_to_send:
-        return RoutingDecision("review", "Email has Drive attachment - always review")
+        return "review", "Email has Drive attachment - always review"
 
     # Known non-personal contacts: always review regardless of autonomy level
     # (colleague, manager, recruiter, vendor all require human eyes)
-    if relationship_type and relationship_type not in ("personal", "unknown"):
-        return RoutingDecision("review", f"Known {relationship_type} contact — always review")
-
-    is_low_confidence = confidence < low_confidence_threshold
+    if non_personal_contact:
+        return "review", "Known {relationship_type} contact — always review"
 
     # --- Level 1: always review ---
     if autonomy_level == 1:
-        return RoutingDecision("review", "Autonomy L1: all emails reviewed")
+        return "review", "Autonomy L1: all emails reviewed"
 
     # --- Level 2: review if any risk flag ---
     if autonomy_level == 2:
         if is_low_confidence:
-            return RoutingDecision("review", f"Low confidence ({confidence:.0%}) - review required")
+            return "review", "Low confidence ({confidence:.0%}) - review required"
         if is_critical:
-            return RoutingDecision("review", "Critical email - review required")
-        return RoutingDecision("send", "High confidence, known sender, not critical")
+            return "review", "Critical email - review required"
+        return "send", "High confidence, known sender, not critical"
 
     # --- Level 3: fully autonomous (except hard rules already caught above) ---
     if autonomy_level == 3:
-        return RoutingDecision("send", "Autonomy L3: sending autonomously")
+        return "send", "Autonomy L3: sending autonomously"
 
     # Fallback
-    return RoutingDecision("review", "Unknown autonomy level - defaulting to review")
+    return "review", "Unknown autonomy level - defaulting to review"
+
+
+# Every (level, flags) outcome precomputed at import; flags packed as bits
+# in _decide's argument order. route() is then one dict lookup per email.
+_LEVELS = (1, 2, 3)
+_TABLE: dict[tuple[int, int], tuple[str, str]] = {
+    (level, flags): _decide(level, *(bool(flags >> bit & 1) for bit in range(5)))
+    for level in _LEVELS
+    for flags in range(32)
+}
+
+
+def route(
+    classification: dict,
+    autonomy_level: int,
+    has_attachments_to_send: bool,
+    low_confidence_threshold: float = 0.70,
+    relationship_type: str = "unknown",
+) -> RoutingDecision:
+    """Determine the action to take for a classified email."""
+
+    needs_reply = classification.get("needs_reply", False)
+    sender_priority = classification.get("sender_priority", "unknown")
+    confidence = classification.get("confidence", 0.0)
+    is_critical = classification.get("is_critical", False)
+
+    if not needs_reply:
+        return RoutingDecision("skip", "No reply needed")
+
+    flags = (
+        (sender_priority == "unknown" or relationship_type == "unknown")
+        | bool(has_attachments_to_send) << 1
+        | bool(relationship_type and relationship_type not in ("personal", "unknown")) << 2
+        | (confidence < low_confidence_threshold) << 3
+        | bool(is_critical) << 4
+    )
+    entry = _TABLE.get((autonomy_level, flags))
+    if entry is None:
+        entry = _decide(autonomy_level, *(bool(flags >> bit & 1) for bit in range(5)))
+    action, reason = entry
+    return RoutingDecision(
+        action,
+        reason.format(confidence=confidence, relationship_type=relationship_type),
+    )
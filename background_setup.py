@@ -3,60 +3,157 @@ Background setup: runs once after a new user authorises.
   1. _generate_voice_profile — analyses sent emails, builds AI voice traits
   2. _analyze_contacts — classifies top recipients for drafting context
 
-Both steps are isolated: failure in one does not block the other.
+Normally both run as one combined Claude call (_generate_profile_and_contacts).
+If that fails, whichever half wasn't saved yet is retried on its own; the
+retries stay isolated, so failure in one does not block the other.
 """
 
 import asyncio
 import json
 import logging
-import os
 import re
 import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import getaddresses
 from typing import Optional
 
 import anthropic
 
 import auth
 import database as db
-from gmail_client import fetch_sent_emails
+from anthropic_client import get_client, parse_json
+from gmail_client import batch_execute, fetch_sent_emails
+
+
+_ANGLE_ADDR_RE = re.compile(r"<([^>]+)>")
+_REPLY_PREFIX_RE = re.compile(r"^(Re:|Fwd?:)\s*", re.IGNORECASE)
 
 
 def _bare_email(addr: str) -> str:
     """Extract bare email address from 'Name <email>' or plain email."""
-    m = re.search(r"<([^>]+)>", addr)
+    m = _ANGLE_ADDR_RE.search(addr)
     return (m.group(1) if m else addr).strip().lower()
 
+
 logger = logging.getLogger(__name__)
 
 
 async def run_setup(user_id: str) -> None:
     """Async entry point — offloads to a thread to avoid blocking the event loop."""
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, _run_setup_sync, user_id)
+    await asyncio.to_thread(_run_setup_sync, user_id)
 
 
 def _run_setup_sync(user_id: str) -> None:
     logger.info(f"[{user_id}] Background setup starting...")
     db.log_event(user_id, "setup_start", "Profile setup started")
 
+    done: set[str] = set()
     try:
-        _generate_voice_profile(user_id)
-    except Exception as e:
-        logger.warning(f"[{user_id}] Voice profile failed: {e}")
-        db.log_event(user_id, "setup_warning", f"Voice profile failed: {e}")
-
-    try:
-        _analyze_contacts(user_id)
+        _generate_profile_and_contacts(user_id, done)
     except Exception as e:
-        logger.warning(f"[{user_id}] Contact analysis failed: {e}")
-        db.log_event(user_id, "setup_warning", f"Contact analysis failed: {e}")
+        # Fall back to the independent steps so one failure can't block the
+        # other; a half the combined run already saved isn't redone
+        logger.warning(f"[{user_id}] Combined profile setup failed, retrying separately: {e}")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            steps = [
+                (label, pool.submit(step, user_id))
+                for key, label, step in (
+                    ("voice", "Voice profile", _generate_voice_profile),
+                    ("contacts", "Contact analysis", _analyze_contacts),
+                )
+                if key not in done
+            ]
+            for label, future in steps:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning(f"[{user_id}] {label} failed: {e}")
+                    db.log_event(user_id, "setup_warning", f"{label} failed: {e}")
 
     db.set_setup_status(user_id, "complete")
     db.log_event(user_id, "setup_complete", "Profile setup finished")
     logger.info(f"[{user_id}] Background setup complete.")
 
 
+# ── Combined voice profile + contact classification ────────────────────────────
+
+def _generate_profile_and_contacts(user_id: str, done: set[str]) -> None:
+    """
+    One Claude call that both infers writing style traits and classifies the
+    top recipients. Results are saved exactly as the two standalone steps would.
+    Adds "voice" / "contacts" to done as each half is saved (or found to have
+    nothing to do), so a caller falling back after an error can skip it.
+    """
+    # The two Gmail fetches are independent — run them side by side. Each worker
+    # thread gets its own service object (httplib2 is not thread-safe).
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        voice_future = pool.submit(
+            lambda: _fetch_voice_samples(auth.get_gmail_service(user_id))
+        )
+        contact_future = pool.submit(
+            lambda: fetch_sent_emails(
+                auth.get_gmail_service(user_id), max_results=500, days=365, headers_only=True
+            )
+        )
+        voice_emails = voice_future.result()
+        contact_emails = contact_future.result()
+    gmail_service = auth.get_gmail_service(user_id)
+    to_counts, to_names, top20 = _tally_recipients(contact_emails)
+
+    if not voice_emails:
+        logger.info(f"[{user_id}] No sent emails found — skipping voice profile")
+        done.add("voice")
+    if not top20:
+        logger.info(f"[{user_id}] No sent emails — skipping contact analysis")
+        done.add("contacts")
+    if not voice_emails and not top20:
+        return
+
+    samples = _voice_samples(voice_emails)
+    sample_text = "\n\n---\n\n".join(samples[:50])  # cap at 50 for prompt size
+    sections = []
+    if samples:
+        sections.append(f"""TASK 1 — Analyse these {len(samples)} email excerpts written by the same person.
+Identify 5-8 concise bullet-point traits that describe their email writing style and voice.
+Focus on: tone, length preference, formality, sign-off style, punctuation habits, common phrases.
+
+Emails:
+{sample_text}""")
+    if top20:
+        sections.append(f"""TASK 2 — Classify these email contacts based on their email addresses, names, and frequency.
+For each, determine:
+- relationship_type: "recruiter" | "colleague" | "manager" | "vendor" | "personal" | "unknown"
+- formality_level: "formal" | "semi-formal" | "casual"
+
+Contacts:
+{_contact_lines(top20, to_counts, to_names)}""")
+
+    prompt = "\n\n".join(sections) + """
+
+Return ONLY a JSON object (no markdown):
+{"traits": ["trait", ...], "contacts": [{"email": "bare address", "name": "Display Name or null", "relationship_type": "...", "formality_level": "..."}]}
+Use an empty list for any task not given above."""
+
+    client = get_client()
+    response = client.messages.create(
+        model="claude-opus-4-6",
+        max_tokens=2000,
+        messages=[{"role": "user", "content": prompt}],
+    )
+    result = parse_json(response.content[0].text)
+
+    if samples:
+        traits = [t.lstrip("- ").strip() for t in result.get("traits", []) if str(t).strip()]
+        logger.info(f"[{user_id}] Voice traits generated: {repr(traits[:2])}")
+        _save_voice_profile(user_id, voice_emails, traits)
+        done.add("voice")
+    if top20:
+        _save_contacts(user_id, gmail_service, client, contact_emails,
+                       to_counts, to_names, top20, result.get("contacts", []))
+        done.add("contacts")
+
+
 # ── Voice profile ──────────────────────────────────────────────────────────────
 
 def _generate_voice_profile(user_id: str) -> None:
@@ -66,24 +163,15 @@ def _generate_voice_profile(user_id: str) -> None:
     """
     gmail_service = auth.get_gmail_service(user_id)
 
-    emails = fetch_sent_emails(gmail_service, max_results=100, days=30, headers_only=False)
-    if len(emails) < 20:
-        # Expand to 90 days if too few samples
-        emails = fetch_sent_emails(gmail_service, max_results=100, days=90, headers_only=False)
+    emails = _fetch_voice_samples(gmail_service)
     if not emails:
         logger.info(f"[{user_id}] No sent emails found — skipping voice profile")
         return
 
-    # Build a compact sample: subject + first 500 chars of body
-    samples = []
-    for e in emails[:100]:
-        subject = e.get("subject", "")
-        body = (e.get("body") or "")[:500]
-        samples.append(f"Subject: {subject}\n{body.strip()}")
-
+    samples = _voice_samples(emails)
     sample_text = "\n\n---\n\n".join(samples[:50])  # cap at 50 for prompt size
 
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    client = get_client()
     prompt = f"""Analyse these {len(samples)} email excerpts written by the same person.
 Identify 5-8 concise bullet-point traits that describe their email writing style and voice.
 Focus on: tone, length preference, formality, sign-off style, punctuation habits, common phrases.
@@ -100,11 +188,35 @@ Emails:
     traits_text = response.content[0].text.strip()
     logger.info(f"[{user_id}] Voice traits generated: {repr(traits_text[:120])}")
 
-    # Merge into existing params
-    params = db.load_user_params(user_id)
-    if "voice_profile" not in params:
-        params["voice_profile"] = {}
     traits = [line.lstrip("- ").strip() for line in traits_text.splitlines() if line.strip()]
+    _save_voice_profile(user_id, emails, traits)
+
+
+def _fetch_voice_samples(gmail_service) -> list[dict]:
+    """Sent emails (full bodies) from the last 30 days, widened to 90 if sparse."""
+    emails = fetch_sent_emails(gmail_service, max_results=100, days=30, headers_only=False)
+    if len(emails) < 20:
+        # Expand to 90 days if too few samples
+        emails = fetch_sent_emails(gmail_service, max_results=100, days=90, headers_only=False)
+    return emails
+
+
+def _voice_samples(emails: list[dict]) -> list[str]:
+    """Build a compact sample: subject + first 500 chars of body."""
+    samples = []
+    for e in emails[:100]:
+        subject = e.get("subject", "")
+        body = (e.get("body") or "")[:500]
+        samples.append(f"Subject: {subject}\n{body.strip()}")
+    return samples
+
+
+def _save_voice_profile(user_id: str, emails: list[dict], traits: list[str]) -> None:
+    """Merge traits and 2-3 real example replies into the user's params."""
+    # load_user_params may return the shared behavior_params defaults; copy
+    # the levels modified below
+    params = dict(db.load_user_params(user_id))
+    params["voice_profile"] = dict(params.get("voice_profile") or {})
 
     # Extract 2-3 short example replies from actual sent emails
     example_bodies = []
@@ -139,35 +251,11 @@ def _analyze_contacts(user_id: str) -> None:
         logger.info(f"[{user_id}] No sent emails — skipping contact analysis")
         return
 
-    # Tally recipients by bare email, collect display names
-    to_counts: Counter = Counter()
-    to_names: dict = {}  # bare_email -> display name
-    for e in emails:
-        to_field = e.get("to", "")
-        for raw_addr in to_field.split(","):
-            raw_addr = raw_addr.strip()
-            if not raw_addr:
-                continue
-            bare = _bare_email(raw_addr)
-            if bare:
-                to_counts[bare] += 1
-                if "<" in raw_addr and bare not in to_names:
-                    name_part = raw_addr.split("<")[0].strip().strip('"')
-                    if name_part:
-                        to_names[bare] = name_part
-
-    top20 = [addr for addr, _ in to_counts.most_common(20)]
+    to_counts, to_names, top20 = _tally_recipients(emails)
     if not top20:
         return
 
-    # Build contact list for classification (include display names when available)
-    contact_lines_parts = []
-    for i, addr in enumerate(top20):
-        display = f"{to_names[addr]} <{addr}>" if addr in to_names else addr
-        contact_lines_parts.append(f"{i+1}. {display} (sent {to_counts[addr]}x)")
-    contact_lines = "\n".join(contact_lines_parts)
-
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    client = get_client()
     prompt = f"""Classify these email contacts based on their email addresses, names, and frequency.
 For each, determine:
 - relationship_type: "recruiter" | "colleague" | "manager" | "vendor" | "personal" | "unknown"
@@ -179,7 +267,7 @@ Return ONLY a JSON array (no markdown), one object per contact, using the bare e
 ]
 
 Contacts:
-{contact_lines}"""
+{_contact_lines(top20, to_counts, to_names)}"""
 
     response = client.messages.create(
         model="claude-opus-4-6",
@@ -187,15 +275,53 @@ Contacts:
         messages=[{"role": "user", "content": prompt}],
     )
 
-    raw = response.content[0].text.strip()
-    raw = re.sub(r"```(?:json)?", "", raw).strip().rstrip("```").strip()
-
     try:
-        contacts = json.loads(raw)
+        contacts = parse_json(response.content[0].text)
     except json.JSONDecodeError as e:
         logger.warning(f"[{user_id}] Contact JSON parse error: {e}")
         return
 
+    _save_contacts(user_id, gmail_service, client, emails, to_counts, to_names, top20, contacts)
+
+
+def _tally_recipients(emails: list[dict]) -> tuple[Counter, dict, list[str]]:
+    """Tally recipients by bare email and collect display names; returns (counts, names, top20)."""
+    # getaddresses handles quoted display names like "Last, First" <x@y>
+    parsed = [
+        (name.strip(), addr.strip().lower())
+        for name, addr in getaddresses([e.get("to", "") for e in emails])
+        if addr.strip()
+    ]
+    to_counts: Counter = Counter(addr for _, addr in parsed)
+    to_names: dict = {}  # bare_email -> display name
+    for name, addr in parsed:
+        if name and addr not in to_names:
+            to_names[addr] = name
+
+    top20 = [addr for addr, _ in to_counts.most_common(20)]
+    return to_counts, to_names, top20
+
+
+def _contact_lines(top20: list[str], to_counts: Counter, to_names: dict) -> str:
+    """Contact list for classification (include display names when available)."""
+    contact_lines_parts = []
+    for i, addr in enumerate(top20):
+        display = f"{to_names[addr]} <{addr}>" if addr in to_names else addr
+        contact_lines_parts.append(f"{i+1}. {display} (sent {to_counts[addr]}x)")
+    return "\n".join(contact_lines_parts)
+
+
+def _save_contacts(
+    user_id: str,
+    gmail_service,
+    client: anthropic.Anthropic,
+    emails: list[dict],
+    to_counts: Counter,
+    to_names: dict,
+    top20: list[str],
+    contacts: list,
+) -> None:
+    """Extract per-contact topics, compute priority scores, and upsert classified contacts."""
     # ── Topic extraction ────────────────────────────────────────────────────
     # Build a set of bare emails for fast lookup
     top20_set = set(top20)
@@ -206,9 +332,8 @@ Contacts:
         subj = e.get("subject", "").strip()
         if not subj:
             continue
-        to_field = e.get("to", "")
-        for raw_addr in to_field.split(","):
-            bare = _bare_email(raw_addr.strip())
+        for _, addr in getaddresses([e.get("to", "")]):
+            bare = addr.strip().lower()
             if bare in top20_set:
                 contact_subjects[bare].append(subj)
 
@@ -222,11 +347,16 @@ Contacts:
             maxResults=300,
         ).execute()
         inbox_msgs = inbox_result.get("messages", [])
-        for msg in inbox_msgs:
-            detail = gmail_service.users().messages().get(
+        details = batch_execute(gmail_service, [
+            gmail_service.users().messages().get(
                 userId="me", id=msg["id"], format="metadata",
-                metadataHeaders=["From", "Subject"]
-            ).execute()
+                metadataHeaders=["From", "Subject"], fields="payload/headers",
+            )
+            for msg in inbox_msgs
+        ])
+        for detail in details:
+            if detail is None:
+                continue
             headers = {h["name"]: h["value"]
                        for h in detail.get("payload", {}).get("headers", [])}
             raw_from = headers.get("From", "")
@@ -245,7 +375,7 @@ Contacts:
         seen = set()
         deduped = []
         for s in contact_subjects[addr]:
-            clean = re.sub(r"^(Re:|Fwd?:)\s*", "", s, flags=re.IGNORECASE).strip().lower()
+            clean = _REPLY_PREFIX_RE.sub("", s).strip().lower()
             if clean and clean not in seen:
                 seen.add(clean)
                 deduped.append(s)
@@ -271,9 +401,7 @@ Contacts:
             max_tokens=1000,
             messages=[{"role": "user", "content": topics_prompt}],
         )
-        topics_raw = topics_resp.content[0].text.strip()
-        topics_raw = re.sub(r"```(?:json)?", "", topics_raw).strip().rstrip("```").strip()
-        topics_map = json.loads(topics_raw)
+        topics_map = parse_json(topics_resp.content[0].text)
     except Exception as e:
         logger.warning(f"[{user_id}] Topic extraction failed (non-fatal): {e}")
 
@@ -285,7 +413,7 @@ Contacts:
     max_count = max(to_counts.values()) if to_counts else 1
 
     now_iso = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
-    saved = 0
+    rows = []
     for c in contacts:
         if not isinstance(c, dict) or not c.get("email"):
             continue
@@ -299,18 +427,18 @@ Contacts:
         contact_topics = topics_map.get(bare, topics_map.get(c["email"], []))
         topics_json = json.dumps(contact_topics) if contact_topics else None
 
-        db.upsert_contact(
-            user_id=user_id,
-            email=bare,
-            name=c.get("name") or to_names.get(bare),
-            relationship_type=rel,
-            formality_level=c.get("formality_level"),
-            interaction_count=count,
-            last_contact_at=now_iso,
-            topics=topics_json,
-            priority_score=priority_score,
-        )
-        saved += 1
-
+        rows.append({
+            "email": bare,
+            "name": c.get("name") or to_names.get(bare),
+            "relationship_type": rel,
+            "formality_level": c.get("formality_level"),
+            "interaction_count": count,
+            "last_contact_at": now_iso,
+            "topics": topics_json,
+            "priority_score": priority_score,
+        })
+
+    db.upsert_contacts_bulk(user_id, rows)
+    saved = len(rows)
     logger.info(f"[{user_id}] {saved} contacts saved with topics and priority scores")
     db.log_event(user_id, "setup_contacts", f"{saved} contacts analysed and saved")
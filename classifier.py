@@ -3,19 +3,28 @@ Classify incoming emails using Claude.
 Returns structured classification dict.
 """
 
+import functools
 import json
 import logging
-import os
 import re
 import time
 from typing import Optional
 
 import anthropic
+from anthropic_client import get_client, parse_json, retry_delay, truncate_tokens
 from config import load_config
 from params import load_params
 
 logger = logging.getLogger(__name__)
 
+_ADDR_RE = re.compile(r"<([^>]+)>")
+
+# Local parts of automated senders that never warrant a reply
+AUTOMATED_LOCAL_PARTS = {
+    "noreply", "no-reply", "no_reply", "donotreply", "do-not-reply", "do_not_reply",
+    "mailer-daemon", "postmaster", "notifications", "notification", "bounce", "bounces",
+}
+
 CLASSIFICATION_SCHEMA = """
 Return ONLY valid JSON matching this schema (no markdown, no explanation):
 {
@@ -42,6 +51,18 @@ Definitions:
 - reasoning: Brief reason for your classification.
 """
 
+# Body token budget sent to the classifier
+MAX_BODY_TOKENS = 500
+
+USER_PROMPT_TEMPLATE = """Classify this email:{contact_block}
+From: {sender}
+Subject: {subject}
+Has Attachments: {has_attachments}
+
+Body:
+{body}
+"""
+
 def _build_classifier_prompt(params: dict) -> str:
     """Build the classifier system prompt from behavior_params.json."""
     identity = params.get("user_identity", {})
@@ -85,6 +106,73 @@ needs_reply = false (skip without replying) when:
 {CLASSIFICATION_SCHEMA}"""
 
 
+@functools.lru_cache(maxsize=16)
+def _cached_classifier_prompt(params_json: str) -> str:
+    """Memoized prompt build — params are the same for every email in a poll."""
+    return _build_classifier_prompt(json.loads(params_json))
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_skip_patterns(patterns: tuple[str, ...]) -> tuple[re.Pattern, ...]:
+    """
+    A user's skip_patterns, compiled once, case-insensitive. Kept separate
+    rather than joined into one alternation, which inline flags like (?m)
+    would break.
+    """
+    return tuple(re.compile(p, re.I) for p in patterns)
+
+
+def _fast_classify(
+    sender: str,
+    contact: Optional[dict],
+    auto_submitted: bool = False,
+    subject: str = "",
+    skip_patterns: Optional[list[str]] = None,
+    list_mail: bool = False,
+) -> Optional[dict]:
+    """
+    Cheap rule-based pass for obvious no-reply mail (automated senders,
+    Auto-Submitted / bulk-Precedence headers, mailing-list headers from
+    unknown senders, and the user's own skip_patterns regexes, matched
+    against the sender and subject). Only header signals are used: an
+    "unsubscribe" in the body alone may be a first-contact email sent
+    from a CRM, or a reply quoting a newsletter. Returns None when Claude
+    should decide.
+    """
+    m = _ADDR_RE.search(sender)
+    addr = (m.group(1) if m else sender).strip().lower()
+    local_part = addr.split("@", 1)[0]
+
+    reason = None
+    if auto_submitted:
+        reason = "Auto-Submitted or bulk Precedence header"
+    elif local_part in AUTOMATED_LOCAL_PARTS:
+        reason = f"Automated sender ({local_part}@)"
+    elif list_mail and not (contact and contact.get("relationship_type")):
+        reason = "Mailing-list headers from unknown sender"
+    elif skip_patterns:
+        text = f"{sender}\n{subject}"
+        for pattern in _compile_skip_patterns(tuple(skip_patterns)):
+            if pattern.search(text):
+                reason = f"Matched skip pattern {pattern.pattern!r}"
+                break
+    if reason is None:
+        return None
+
+    return {
+        "needs_reply": False,
+        "sender_priority": "low",
+        "confidence": 0.95,
+        "is_critical": False,
+        "needs_calendar": False,
+        "calendar_days_requested": None,
+        "needs_gdrive": False,
+        "gdrive_query": None,
+        "reasoning": f"Rule-based: {reason}",
+        "fast_path": True,
+    }
+
+
 def classify_email(
     sender: str,
     subject: str,
@@ -93,14 +181,28 @@ def classify_email(
     params: dict = None,
     model: str = None,
     contact: Optional[dict] = None,
+    auto_submitted: bool = False,
+    skip_patterns: Optional[list[str]] = None,
+    list_mail: bool = False,
 ) -> dict:
-    """Classify an email and return structured classification."""
+    """
+    Classify an email and return structured classification.
+    auto_submitted: the message's headers mark it machine-sent (see gmail_client).
+    skip_patterns: the user's regexes for mail that never needs a reply.
+    list_mail: the message has mailing-list headers (see gmail_client).
+    """
+    fast = _fast_classify(sender, contact, auto_submitted, subject, skip_patterns, list_mail)
+    if fast is not None:
+        logger.info(f"Fast-path classification: {fast['reasoning']}")
+        return fast
+
     if params is None:
         params = load_params()
     if model is None:
         model = load_config()["anthropic_model"]
-    system_prompt = _build_classifier_prompt(params)
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    system_prompt = _cached_classifier_prompt(json.dumps(params, sort_keys=True))
+    # This function runs its own retry loop; don't stack SDK retries under it
+    client = get_client().with_options(max_retries=0)
 
     contact_block = ""
     if contact and contact.get("relationship_type"):
@@ -113,30 +215,28 @@ def classify_email(
             + ".\n"
         )
 
-    user_prompt = f"""Classify this email:{contact_block}
-From: {sender}
-Subject: {subject}
-Has Attachments: {has_attachments}
-
-Body:
-{body[:2000]}
-"""
+    user_prompt = USER_PROMPT_TEMPLATE.format(
+        contact_block=contact_block,
+        sender=sender,
+        subject=subject,
+        has_attachments=has_attachments,
+        body=truncate_tokens(body, MAX_BODY_TOKENS),
+    )
 
-    max_retries = 3
+    max_retries = 4
     last_error = None
     for attempt in range(max_retries):
         try:
             response = client.messages.create(
                 model=model,
                 max_tokens=512,
-                system=system_prompt,
+                # Stable per user: let Anthropic reuse the cached prefix across emails
+                system=[{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
                 messages=[{"role": "user", "content": user_prompt}],
             )
 
-            raw = response.content[0].text.strip()
-            # Strip markdown code fences if present
-            raw = re.sub(r"```(?:json)?", "", raw).strip().rstrip("```").strip()
-            result = json.loads(raw)
+            # Decodes past any markdown code fences around the JSON
+            result = parse_json(response.content[0].text)
 
             # Validate required keys
             required = ["needs_reply", "sender_priority", "confidence", "is_critical",
@@ -147,15 +247,13 @@ Body:
 
             return result
 
-        except anthropic.APIStatusError as e:
-            if e.status_code == 529 and attempt < max_retries - 1:
-                wait = 10 * (attempt + 1)
-                logger.warning(f"Anthropic overloaded (529), retrying in {wait}s... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(wait)
-                last_error = e
-            else:
-                last_error = e
+        except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+            last_error = e
+            wait = retry_delay(e, attempt)
+            if wait is None or attempt == max_retries - 1:
                 break
+            logger.warning(f"Anthropic error ({e}), retrying in {wait:.1f}s... (attempt {attempt + 1}/{max_retries})")
+            time.sleep(wait)
         except Exception as e:
             last_error = e
             break
@@ -14,16 +14,27 @@ DEFAULTS = {
     "lookback_hours": 72,
 }
 
+# (mtime of CONFIG_FILE or None if missing, merged config) — re-read only when the file changes
+_cached: tuple = None
+
+
 def load_config() -> dict:
-    if CONFIG_FILE.exists():
-        with open(CONFIG_FILE) as f:
-            data = json.load(f)
-        return {**DEFAULTS, **data}
-    return DEFAULTS.copy()
+    global _cached
+    mtime = CONFIG_FILE.stat().st_mtime if CONFIG_FILE.exists() else None
+    if _cached is None or _cached[0] != mtime:
+        if mtime is not None:
+            with open(CONFIG_FILE) as f:
+                data = json.load(f)
+            _cached = (mtime, {**DEFAULTS, **data})
+        else:
+            _cached = (None, DEFAULTS.copy())
+    return _cached[1].copy()  # copy so callers can't mutate the cache
 
 def save_config(updates: dict) -> dict:
+    global _cached
     config = load_config()
     config.update(updates)
     with open(CONFIG_FILE, "w") as f:
         json.dump(config, f, indent=2)
+    _cached = None
     return config
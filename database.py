@@ -4,10 +4,16 @@ and multi-user tables (users, tokens, configs, contacts).
 """
 
 import json
+import logging
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
 
 DB_FILE = Path("gmail_replier.db")
 
@@ -21,209 +27,247 @@ CONFIG_DEFAULTS = {
     "low_confidence_threshold": 0.70,
     "user_timezone": "America/Chicago",
     "lookback_hours": 72,
+    # Regexes (case-insensitive) matched against sender and subject; a hit
+    # skips the email without a Claude call
+    "skip_patterns": [],
 }
 
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(str(DB_FILE))
+# Reads use one connection per thread, reused across calls (scheduler +
+# request threads). Writes go through a single shared connection guarded by
+# a lock, so concurrent writers queue here instead of busy-waiting on
+# SQLite's file lock. Both are opened lazily and reopened if DB_FILE changes.
+_local = threading.local()
+_writer: Optional[sqlite3.Connection] = None
+_writer_path: Optional[str] = None
+_writer_lock = threading.RLock()
+
+
+def _connect(check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(DB_FILE), check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
+    # WAL for concurrent reads during scheduler polls; NORMAL sync is safe under WAL
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")   # 256 MiB, read via mmap
+    conn.execute("PRAGMA cache_size=-16384")     # 16 MiB page cache per connection
     return conn
 
 
-def init_db():
-    with get_conn() as conn:
-        # WAL mode for concurrent reads during scheduler polls
-        conn.execute("PRAGMA journal_mode=WAL")
-        conn.execute("PRAGMA synchronous=NORMAL")
+def get_conn() -> sqlite3.Connection:
+    """This thread's read connection."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != str(DB_FILE):
+        conn = _connect()
+        _local.conn = conn
+        _local.path = str(DB_FILE)
+    return conn
 
-        # ── New multi-user tables ──────────────────────────────────────────
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id           TEXT PRIMARY KEY,
-                email             TEXT NOT NULL UNIQUE,
-                display_name      TEXT,
-                service_start_epoch INTEGER,
-                user_params       TEXT,
-                setup_status      TEXT NOT NULL DEFAULT 'pending',
-                created_at        TEXT NOT NULL DEFAULT (datetime('now')),
-                updated_at        TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                user_id    TEXT PRIMARY KEY,
-                token_json TEXT NOT NULL,
-                updated_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_configs (
-                user_id     TEXT PRIMARY KEY,
-                config_json TEXT NOT NULL,
-                updated_at  TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_contacts (
-                id                INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id           TEXT NOT NULL,
-                email             TEXT NOT NULL,
-                name              TEXT,
-                relationship_type TEXT,
-                formality_level   TEXT,
-                interaction_count INTEGER DEFAULT 0,
-                last_contact_at   TEXT,
-                UNIQUE(user_id, email),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
+
+@contextmanager
+def write_conn() -> Iterator[sqlite3.Connection]:
+    """The shared write connection, held exclusively; commits on exit, rolls back on error."""
+    global _writer, _writer_path
+    with _writer_lock:
+        if _writer is None or _writer_path != str(DB_FILE):
+            _writer = _connect(check_same_thread=False)
+            _writer_path = str(DB_FILE)
+        with _writer:
+            yield _writer
+
+
+# Full current schema; every statement is idempotent so it runs on each startup
+_SCHEMA = """
+-- ── Multi-user tables ──────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS users (
+    user_id           TEXT PRIMARY KEY,
+    email             TEXT NOT NULL UNIQUE,
+    display_name      TEXT,
+    service_start_epoch INTEGER,
+    last_history_id   TEXT,
+    user_params       TEXT,
+    setup_status      TEXT NOT NULL DEFAULT 'pending',
+    created_at        TEXT NOT NULL DEFAULT (datetime('now')),
+    updated_at        TEXT NOT NULL DEFAULT (datetime('now'))
+);
+CREATE TABLE IF NOT EXISTS user_tokens (
+    user_id    TEXT PRIMARY KEY,
+    token_json TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE IF NOT EXISTS user_configs (
+    user_id     TEXT PRIMARY KEY,
+    config_json TEXT NOT NULL,
+    updated_at  TEXT NOT NULL DEFAULT (datetime('now')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE IF NOT EXISTS user_contacts (
+    id                INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id           TEXT NOT NULL,
+    email             TEXT NOT NULL,
+    name              TEXT,
+    relationship_type TEXT,
+    formality_level   TEXT,
+    interaction_count INTEGER DEFAULT 0,
+    last_contact_at   TEXT,
+    UNIQUE(user_id, email),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+{processed_emails}
+{review_queue}
+{activity_log}
+
+-- ── Indexes ────────────────────────────────────────────────────────────
+-- processed_emails(user_id, message_id) and review_queue(user_id, message_id)
+-- are already covered by their UNIQUE constraints' autoindexes
+DROP INDEX IF EXISTS idx_processed_user;
+DROP INDEX IF EXISTS idx_review_user;
+-- Serves both the all-items and pending listings (the latter filters status
+-- while walking it), so the old partial idx_queue_pending on the same
+-- columns is dropped
+DROP INDEX IF EXISTS idx_queue_pending;
+CREATE INDEX IF NOT EXISTS idx_review_user_created ON review_queue(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_activity_user ON activity_log(user_id);
+CREATE INDEX IF NOT EXISTS idx_contacts_user ON user_contacts(user_id);
+"""
+
+# Tables that predate multi-user support; the legacy migration rebuilds them
+# under the same definitions.
+_LEGACY_TABLES = {
+    "processed_emails": """
+CREATE TABLE IF NOT EXISTS {name} (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id      TEXT NOT NULL DEFAULT 'legacy',
+    message_id   TEXT NOT NULL,
+    thread_id    TEXT,
+    processed_at TEXT,
+    UNIQUE(user_id, message_id)
+);""",
+    "review_queue": """
+CREATE TABLE IF NOT EXISTS {name} (
+    id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id        TEXT NOT NULL DEFAULT 'legacy',
+    message_id     TEXT,
+    thread_id      TEXT,
+    sender         TEXT,
+    subject        TEXT,
+    snippet        TEXT,
+    body           TEXT,
+    draft_reply    TEXT,
+    classification TEXT,
+    status         TEXT DEFAULT 'pending',
+    action_taken   TEXT,
+    created_at     TEXT,
+    updated_at     TEXT,
+    UNIQUE(user_id, message_id)
+);""",
+    "activity_log": """
+CREATE TABLE IF NOT EXISTS {name} (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id    TEXT NOT NULL DEFAULT 'legacy',
+    event_type TEXT,
+    message    TEXT,
+    created_at TEXT
+);""",
+}
+
+# Columns copied from each legacy single-user table into its rebuilt form
+_LEGACY_COLUMNS = {
+    "processed_emails": "message_id, thread_id, processed_at",
+    "review_queue": (
+        "id, message_id, thread_id, sender, subject, snippet, body, "
+        "draft_reply, classification, status, action_taken, created_at, updated_at"
+    ),
+    "activity_log": "id, event_type, message, created_at",
+}
+
+
+# Stored in PRAGMA user_version once init_db has brought a DB fully up to
+# date; bump it whenever _SCHEMA or a migration changes.
+SCHEMA_VERSION = 4
+
+
+def init_db():
+    with write_conn() as conn:
+        # Up-to-date DBs skip the migration checks and schema script entirely
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
 
         # ── Existing tables: migrate to add user_id if not present ─────────
         _migrate_existing_tables(conn)
 
-        # ── Indexes ────────────────────────────────────────────────────────
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_user ON processed_emails(user_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_review_user ON review_queue(user_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_activity_user ON activity_log(user_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_contacts_user ON user_contacts(user_id)")
+        # One script, one write transaction for all the CREATE/DROP statements
+        schema = _SCHEMA.format(**{
+            name: ddl.format(name=name) for name, ddl in _LEGACY_TABLES.items()
+        })
+        conn.executescript(f"BEGIN IMMEDIATE;\n{schema}\nCOMMIT;")
 
-        # ── Schema migrations for user_contacts ────────────────────────────
+        # ── Column migrations ───────────────────────────────────────────────
         _migrate_contacts_schema(conn)
-        conn.commit()
+        _migrate_users_schema(conn)
+
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+# A queue item still 'sending' after this long was abandoned mid-action
+SENDING_RECLAIM_MINUTES = 10
+
+
+def run_maintenance() -> None:
+    """
+    Reclaim abandoned 'sending' queue items, refresh query-planner
+    statistics and truncate the WAL file.
+    Connections are long-lived, so the scheduler calls this periodically
+    rather than on close.
+    """
+    with write_conn() as conn:
+        # Items left in 'sending' by a worker that died mid-action; put them
+        # back to pending so the user can act on them again. Committed on its
+        # own: the checkpoint below can't run inside a transaction.
+        conn.execute(
+            f"""UPDATE review_queue SET status='pending', updated_at={NOW_SQL}
+                WHERE status='sending'
+                  AND updated_at < strftime('%Y-%m-%dT%H:%M:%f','now','-{SENDING_RECLAIM_MINUTES} minutes')"""
+        )
+    with write_conn() as conn:
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
 
 def _migrate_contacts_schema(conn: sqlite3.Connection) -> None:
     """Add topics and priority_score columns to user_contacts if they don't exist yet."""
     for col, definition in [("topics", "TEXT"), ("priority_score", "REAL DEFAULT 0")]:
-        try:
+        if not _table_has_column(conn, "user_contacts", col):
             conn.execute(f"ALTER TABLE user_contacts ADD COLUMN {col} {definition}")
-        except Exception:
-            pass  # column already exists
+
+
+def _migrate_users_schema(conn: sqlite3.Connection) -> None:
+    """Add last_history_id to users if it doesn't exist yet."""
+    if not _table_has_column(conn, "users", "last_history_id"):
+        conn.execute("ALTER TABLE users ADD COLUMN last_history_id TEXT")
 
 
 def _migrate_existing_tables(conn: sqlite3.Connection):
     """
     Migrate pre-existing single-user tables to include user_id.
-    Safe to call on fresh DBs (tables don't exist yet) and on already-migrated DBs.
+    Only legacy tables are rebuilt; fresh and already-migrated DBs are left
+    for the schema script to create.
     """
-    # processed_emails
-    if not _table_has_column(conn, "processed_emails", "user_id"):
-        old_exists = _table_exists(conn, "processed_emails")
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS processed_emails_new (
-                id           INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id      TEXT NOT NULL DEFAULT 'legacy',
-                message_id   TEXT NOT NULL,
-                thread_id    TEXT,
-                processed_at TEXT,
-                UNIQUE(user_id, message_id)
-            )
-        """)
-        if old_exists:
-            conn.execute("""
-                INSERT OR IGNORE INTO processed_emails_new (user_id, message_id, thread_id, processed_at)
-                SELECT 'legacy', message_id, thread_id, processed_at FROM processed_emails
-            """)
-            conn.execute("DROP TABLE processed_emails")
-        conn.execute("ALTER TABLE processed_emails_new RENAME TO processed_emails")
-    else:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS processed_emails (
-                id           INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id      TEXT NOT NULL DEFAULT 'legacy',
-                message_id   TEXT NOT NULL,
-                thread_id    TEXT,
-                processed_at TEXT,
-                UNIQUE(user_id, message_id)
-            )
-        """)
-
-    # review_queue
-    if not _table_has_column(conn, "review_queue", "user_id"):
-        old_exists = _table_exists(conn, "review_queue")
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS review_queue_new (
-                id             INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id        TEXT NOT NULL DEFAULT 'legacy',
-                message_id     TEXT,
-                thread_id      TEXT,
-                sender         TEXT,
-                subject        TEXT,
-                snippet        TEXT,
-                body           TEXT,
-                draft_reply    TEXT,
-                classification TEXT,
-                status         TEXT DEFAULT 'pending',
-                action_taken   TEXT,
-                created_at     TEXT,
-                updated_at     TEXT,
-                UNIQUE(user_id, message_id)
-            )
-        """)
-        if old_exists:
-            conn.execute("""
-                INSERT OR IGNORE INTO review_queue_new
-                (user_id, id, message_id, thread_id, sender, subject, snippet, body,
-                 draft_reply, classification, status, action_taken, created_at, updated_at)
-                SELECT 'legacy', id, message_id, thread_id, sender, subject, snippet, body,
-                       draft_reply, classification, status, action_taken, created_at, updated_at
-                FROM review_queue
-            """)
-            conn.execute("DROP TABLE review_queue")
-        conn.execute("ALTER TABLE review_queue_new RENAME TO review_queue")
-    else:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS review_queue (
-                id             INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id        TEXT NOT NULL DEFAULT 'legacy',
-                message_id     TEXT,
-                thread_id      TEXT,
-                sender         TEXT,
-                subject        TEXT,
-                snippet        TEXT,
-                body           TEXT,
-                draft_reply    TEXT,
-                classification TEXT,
-                status         TEXT DEFAULT 'pending',
-                action_taken   TEXT,
-                created_at     TEXT,
-                updated_at     TEXT,
-                UNIQUE(user_id, message_id)
-            )
-        """)
-
-    # activity_log
-    if not _table_has_column(conn, "activity_log", "user_id"):
-        old_exists = _table_exists(conn, "activity_log")
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS activity_log_new (
-                id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id    TEXT NOT NULL DEFAULT 'legacy',
-                event_type TEXT,
-                message    TEXT,
-                created_at TEXT
-            )
-        """)
-        if old_exists:
-            conn.execute("""
-                INSERT OR IGNORE INTO activity_log_new (user_id, id, event_type, message, created_at)
-                SELECT 'legacy', id, event_type, message, created_at FROM activity_log
-            """)
-            conn.execute("DROP TABLE activity_log")
-        conn.execute("ALTER TABLE activity_log_new RENAME TO activity_log")
-    else:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS activity_log (
-                id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id    TEXT NOT NULL DEFAULT 'legacy',
-                event_type TEXT,
-                message    TEXT,
-                created_at TEXT
-            )
+    for table, ddl in _LEGACY_TABLES.items():
+        if not _table_exists(conn, table) or _table_has_column(conn, table, "user_id"):
+            continue
+        cols = _LEGACY_COLUMNS[table]
+        conn.execute(ddl.format(name=f"{table}_new"))
+        conn.execute(f"""
+            INSERT OR IGNORE INTO {table}_new (user_id, {cols})
+            SELECT 'legacy', {cols} FROM {table}
         """)
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
 
 
 def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
@@ -234,10 +278,17 @@ def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
 
 
 def _table_has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
-    if not _table_exists(conn, table):
-        return False
-    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
-    return any(r["name"] == column for r in rows)
+    # pragma_table_info yields no rows for a missing table
+    row = conn.execute(
+        "SELECT 1 FROM pragma_table_info(?) WHERE name=? LIMIT 1", (table, column)
+    ).fetchone()
+    return row is not None
+
+
+# SQL expression for the current UTC time, in the same naive ISO-8601 form
+# older rows were written with (datetime.utcnow().isoformat()); evaluated by SQLite
+# so write paths don't build and format a datetime per row.
+NOW_SQL = "strftime('%Y-%m-%dT%H:%M:%f','now')"
 
 
 # ── User management ────────────────────────────────────────────────────────────
@@ -249,36 +300,50 @@ def get_user(user_id: str) -> Optional[dict]:
 
 
 def upsert_user(user_id: str, email: str, display_name: str) -> None:
-    now = datetime.utcnow().isoformat()
-    with get_conn() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO users (user_id, email, display_name, created_at, updated_at) VALUES (?,?,?,?,?)",
-            (user_id, email, display_name, now, now),
-        )
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE users SET email=?, display_name=?, updated_at=? WHERE user_id=?",
-            (email, display_name, now, user_id),
+            f"""
+            INSERT INTO users (user_id, email, display_name, created_at, updated_at)
+            VALUES (?,?,?,{NOW_SQL},{NOW_SQL})
+            ON CONFLICT(user_id) DO UPDATE SET
+                email=excluded.email,
+                display_name=excluded.display_name,
+                updated_at=excluded.updated_at
+            """,
+            (user_id, email, display_name),
         )
-        conn.commit()
 
 
 def set_service_start_epoch(user_id: str, epoch: int) -> None:
     """Set service_start_epoch only if it hasn't been set yet (first login)."""
+    with write_conn() as conn:
+        conn.execute(
+            f"UPDATE users SET service_start_epoch=?, updated_at={NOW_SQL} WHERE user_id=? AND service_start_epoch IS NULL",
+            (epoch, user_id),
+        )
+
+
+def get_history_id(user_id: str) -> Optional[str]:
+    """Gmail historyId as of the user's last completed poll, if any."""
     with get_conn() as conn:
+        row = conn.execute("SELECT last_history_id FROM users WHERE user_id=?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_history_id(user_id: str, history_id: Optional[str]) -> None:
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE users SET service_start_epoch=?, updated_at=? WHERE user_id=? AND service_start_epoch IS NULL",
-            (epoch, datetime.utcnow().isoformat(), user_id),
+            f"UPDATE users SET last_history_id=?, updated_at={NOW_SQL} WHERE user_id=?",
+            (history_id, user_id),
         )
-        conn.commit()
 
 
 def set_setup_status(user_id: str, status: str) -> None:
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE users SET setup_status=?, updated_at=? WHERE user_id=?",
-            (status, datetime.utcnow().isoformat(), user_id),
+            f"UPDATE users SET setup_status=?, updated_at={NOW_SQL} WHERE user_id=?",
+            (status, user_id),
         )
-        conn.commit()
 
 
 def get_all_users_with_tokens() -> list[str]:
@@ -288,16 +353,27 @@ def get_all_users_with_tokens() -> list[str]:
     return [r["user_id"] for r in rows]
 
 
+def load_configs_for_token_users() -> dict[str, dict]:
+    """user_id -> config (with defaults) for every user with a stored token, in one query."""
+    with get_conn() as conn:
+        rows = conn.execute("""
+            SELECT t.user_id, c.config_json
+            FROM user_tokens t LEFT JOIN user_configs c ON c.user_id = t.user_id
+        """).fetchall()
+    return {
+        r["user_id"]: {**CONFIG_DEFAULTS, **(json.loads(r["config_json"]) if r["config_json"] else {})}
+        for r in rows
+    }
+
+
 # ── Token storage ──────────────────────────────────────────────────────────────
 
 def save_token(user_id: str, token_dict: dict) -> None:
-    now = datetime.utcnow().isoformat()
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "INSERT OR REPLACE INTO user_tokens (user_id, token_json, updated_at) VALUES (?,?,?)",
-            (user_id, json.dumps(token_dict), now),
+            f"INSERT OR REPLACE INTO user_tokens (user_id, token_json, updated_at) VALUES (?,?,{NOW_SQL})",
+            (user_id, json.dumps(token_dict)),
         )
-        conn.commit()
 
 
 def load_token(user_id: str) -> Optional[dict]:
@@ -312,50 +388,106 @@ def load_token(user_id: str) -> Optional[dict]:
 
 # ── Per-user config ────────────────────────────────────────────────────────────
 
+# Decoded config / params are read on every poll and dashboard load but only
+# change through the save_* functions below, which drop the cached copy.
+# The TTL just bounds staleness if the DB is edited behind our back.
+USER_CACHE_TTL_SECONDS = 60
+# ("config" | "params", user_id) -> (monotonic time, decoded dict)
+_user_cache: dict[tuple[str, str], tuple[float, dict]] = {}
+_user_cache_lock = threading.Lock()
+
+
+def _user_cache_get(kind: str, user_id: str) -> Optional[dict]:
+    with _user_cache_lock:
+        entry = _user_cache.get((kind, user_id))
+    if entry is not None and time.monotonic() - entry[0] < USER_CACHE_TTL_SECONDS:
+        return entry[1]
+    return None
+
+
+def _user_cache_put(kind: str, user_id: str, value: dict) -> None:
+    with _user_cache_lock:
+        _user_cache[(kind, user_id)] = (time.monotonic(), value)
+
+
+def _user_cache_drop(kind: str, user_id: str) -> None:
+    with _user_cache_lock:
+        _user_cache.pop((kind, user_id), None)
+
+
 def load_user_config(user_id: str) -> dict:
-    with get_conn() as conn:
-        row = conn.execute(
-            "SELECT config_json FROM user_configs WHERE user_id=?", (user_id,)
-        ).fetchone()
-    stored = json.loads(row["config_json"]) if row else {}
-    return {**CONFIG_DEFAULTS, **stored}
+    config = _user_cache_get("config", user_id)
+    if config is None:
+        with get_conn() as conn:
+            row = conn.execute(
+                "SELECT config_json FROM user_configs WHERE user_id=?", (user_id,)
+            ).fetchone()
+        stored = json.loads(row["config_json"]) if row else {}
+        config = {**CONFIG_DEFAULTS, **stored}
+        _user_cache_put("config", user_id, config)
+    return config.copy()  # copy so callers can't mutate the cache
 
 
 def save_user_config(user_id: str, config: dict) -> None:
-    now = datetime.utcnow().isoformat()
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "INSERT OR REPLACE INTO user_configs (user_id, config_json, updated_at) VALUES (?,?,?)",
-            (user_id, json.dumps(config), now),
+            f"INSERT OR REPLACE INTO user_configs (user_id, config_json, updated_at) VALUES (?,?,{NOW_SQL})",
+            (user_id, json.dumps(config)),
         )
-        conn.commit()
+    _user_cache_drop("config", user_id)
 
 
 # ── Per-user params ────────────────────────────────────────────────────────────
 
 def load_user_params(user_id: str) -> dict:
-    """Return per-user behavior params; falls back to behavior_params.json."""
+    """
+    Return per-user behavior params; falls back to behavior_params.json.
+    The returned dict is shared (cached here, or params.load_params for the
+    fallback), so copy before modifying.
+    """
+    params = _user_cache_get("params", user_id)
+    if params is not None:
+        return params
     with get_conn() as conn:
         row = conn.execute(
             "SELECT user_params FROM users WHERE user_id=?", (user_id,)
         ).fetchone()
     if row and row["user_params"]:
-        return json.loads(row["user_params"])
+        params = json.loads(row["user_params"])
+        _user_cache_put("params", user_id, params)
+        return params
+    # Not cached here: load_params already re-reads only when the file changes
     from params import load_params
     return load_params()
 
 
 def save_user_params(user_id: str, params: dict) -> None:
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE users SET user_params=?, updated_at=? WHERE user_id=?",
-            (json.dumps(params), datetime.utcnow().isoformat(), user_id),
+            f"UPDATE users SET user_params=?, updated_at={NOW_SQL} WHERE user_id=?",
+            (json.dumps(params), user_id),
         )
-        conn.commit()
+    _user_cache_drop("params", user_id)
 
 
 # ── Contacts ───────────────────────────────────────────────────────────────────
 
+_UPSERT_CONTACT_SQL = """
+    INSERT INTO user_contacts
+        (user_id, email, name, relationship_type, formality_level,
+         interaction_count, last_contact_at, topics, priority_score)
+    VALUES (?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(user_id, email) DO UPDATE SET
+        name=excluded.name,
+        relationship_type=excluded.relationship_type,
+        formality_level=excluded.formality_level,
+        interaction_count=excluded.interaction_count,
+        last_contact_at=excluded.last_contact_at,
+        topics=excluded.topics,
+        priority_score=excluded.priority_score
+"""
+
+
 def upsert_contact(
     user_id: str,
     email: str,
@@ -367,26 +499,26 @@ def upsert_contact(
     topics: Optional[str] = None,
     priority_score: float = 0.0,
 ) -> None:
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            """
-            INSERT INTO user_contacts
-                (user_id, email, name, relationship_type, formality_level,
-                 interaction_count, last_contact_at, topics, priority_score)
-            VALUES (?,?,?,?,?,?,?,?,?)
-            ON CONFLICT(user_id, email) DO UPDATE SET
-                name=excluded.name,
-                relationship_type=excluded.relationship_type,
-                formality_level=excluded.formality_level,
-                interaction_count=excluded.interaction_count,
-                last_contact_at=excluded.last_contact_at,
-                topics=excluded.topics,
-                priority_score=excluded.priority_score
-            """,
+            _UPSERT_CONTACT_SQL,
             (user_id, email, name, relationship_type, formality_level,
              interaction_count, last_contact_at, topics, priority_score),
         )
-        conn.commit()
+
+
+def upsert_contacts_bulk(user_id: str, rows: list[dict]) -> None:
+    """Upsert many contacts in one transaction. Each row has upsert_contact's keyword fields."""
+    params = [
+        (user_id, r["email"], r.get("name"), r.get("relationship_type"), r.get("formality_level"),
+         r.get("interaction_count", 0), r.get("last_contact_at"), r.get("topics"),
+         r.get("priority_score", 0.0))
+        for r in rows
+    ]
+    if not params:
+        return
+    with write_conn() as conn:
+        conn.executemany(_UPSERT_CONTACT_SQL, params)
 
 
 def get_contacts(user_id: str) -> list[dict]:
@@ -414,41 +546,83 @@ def update_contact_details(
     relationship_type: Optional[str],
     formality_level: Optional[str],
 ) -> None:
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
             "UPDATE user_contacts SET name=?, relationship_type=?, formality_level=? WHERE user_id=? AND email=?",
             (name, relationship_type, formality_level, user_id, email),
         )
-        conn.commit()
 
 
 def delete_contact(user_id: str, email: str) -> None:
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
             "DELETE FROM user_contacts WHERE user_id=? AND email=?",
             (user_id, email),
         )
-        conn.commit()
 
 
 # ── Email processing ───────────────────────────────────────────────────────────
 
+# (user_id, message_id) pairs known to be processed. Rows are never deleted,
+# so positive lookups can be served from memory on later polls. LRU-bounded:
+# an evicted pair just falls back to the indexed EXISTS query.
+PROCESSED_CACHE_MAX = 5000
+_processed_cache: OrderedDict[tuple[str, str], None] = OrderedDict()
+_processed_cache_lock = threading.Lock()
+
+
+def _processed_cache_add(keys) -> None:
+    with _processed_cache_lock:
+        for key in keys:
+            _processed_cache[key] = None
+            _processed_cache.move_to_end(key)
+        while len(_processed_cache) > PROCESSED_CACHE_MAX:
+            _processed_cache.popitem(last=False)
+
+
+def _processed_cache_hit(key: tuple[str, str]) -> bool:
+    with _processed_cache_lock:
+        if key not in _processed_cache:
+            return False
+        _processed_cache.move_to_end(key)
+        return True
+
+
 def mark_processed(user_id: str, message_id: str, thread_id: str):
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "INSERT OR IGNORE INTO processed_emails (user_id, message_id, thread_id, processed_at) VALUES (?,?,?,?)",
-            (user_id, message_id, thread_id, datetime.utcnow().isoformat()),
+            "INSERT OR IGNORE INTO processed_emails (user_id, message_id, thread_id, processed_at) "
+            f"VALUES (?,?,?,{NOW_SQL})",
+            (user_id, message_id, thread_id),
         )
-        conn.commit()
+    _processed_cache_add([(user_id, message_id)])
+
+
+def mark_processed_bulk(user_id: str, pairs: list[tuple[str, str]]) -> None:
+    """Mark many (message_id, thread_id) pairs processed in one transaction."""
+    if not pairs:
+        return
+    with write_conn() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO processed_emails (user_id, message_id, thread_id, processed_at) "
+            f"VALUES (?,?,?,{NOW_SQL})",
+            [(user_id, message_id, thread_id) for message_id, thread_id in pairs],
+        )
+    _processed_cache_add((user_id, message_id) for message_id, _ in pairs)
 
 
 def is_processed(user_id: str, message_id: str) -> bool:
+    if _processed_cache_hit((user_id, message_id)):
+        return True
     with get_conn() as conn:
         row = conn.execute(
-            "SELECT 1 FROM processed_emails WHERE user_id=? AND message_id=?",
+            "SELECT EXISTS(SELECT 1 FROM processed_emails WHERE user_id=? AND message_id=?)",
             (user_id, message_id),
         ).fetchone()
-    return row is not None
+    if row[0]:
+        _processed_cache_add([(user_id, message_id)])
+        return True
+    return False
 
 
 # ── Review queue ───────────────────────────────────────────────────────────────
@@ -464,40 +638,76 @@ def add_to_review_queue(
     draft_reply: str,
     classification: dict,
 ) -> int:
-    now = datetime.utcnow().isoformat()
-    with get_conn() as conn:
+    with write_conn() as conn:
         cur = conn.execute(
-            """
+            f"""
             INSERT OR REPLACE INTO review_queue
             (user_id, message_id, thread_id, sender, subject, snippet, body,
              draft_reply, classification, status, created_at, updated_at)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+            VALUES (?,?,?,?,?,?,?,?,?,?,{NOW_SQL},{NOW_SQL})
             """,
             (
                 user_id, message_id, thread_id, sender, subject, snippet, body,
-                draft_reply, json.dumps(classification), "pending", now, now,
+                draft_reply, json.dumps(classification), "pending",
             ),
         )
-        conn.commit()
         return cur.lastrowid
 
 
-def get_pending_queue(user_id: str) -> list[dict]:
+def get_pending_queue(user_id: str, parse_classification: bool = True) -> list[dict]:
+    """Pending items, newest first. parse_classification=False leaves classification as raw JSON text."""
     with get_conn() as conn:
         rows = conn.execute(
             "SELECT * FROM review_queue WHERE user_id=? AND status='pending' ORDER BY created_at DESC",
             (user_id,),
         ).fetchall()
-    return [_row_to_dict(r) for r in rows]
+    return [_row_to_dict(r, parse_classification) for r in rows]
 
 
-def get_all_queue(user_id: str, limit: int = 100) -> list[dict]:
+def get_all_queue(user_id: str, limit: int = 100, parse_classification: bool = True) -> list[dict]:
+    """All items, newest first. parse_classification=False leaves classification as raw JSON text."""
     with get_conn() as conn:
         rows = conn.execute(
             "SELECT * FROM review_queue WHERE user_id=? ORDER BY created_at DESC LIMIT ?",
             (user_id, limit),
         ).fetchall()
-    return [_row_to_dict(r) for r in rows]
+    return [_row_to_dict(r, parse_classification) for r in rows]
+
+
+# Classification fields the dashboard cards render, extracted in SQL so list
+# views never parse the full classification JSON in Python
+_SUMMARY_CLASSIFICATION_FIELDS = ("sender_priority", "confidence", "is_critical")
+_SUMMARY_CLASSIFICATION_SQL = ", ".join(
+    f"CASE WHEN json_valid(classification) THEN json_extract(classification, '$.{f}') END AS cls_{f}"
+    for f in _SUMMARY_CLASSIFICATION_FIELDS
+)
+
+
+def get_queue_summary(
+    user_id: str, pending_only: bool = False, limit: int = 100, offset: int = 0,
+) -> list[dict]:
+    """
+    Queue rows for list views, newest first. Leaves out the wide body and
+    draft_reply columns, and classification holds only sender_priority /
+    confidence / is_critical; use get_queue_item for the full row.
+    """
+    status_filter = "AND status='pending' " if pending_only else ""
+    with get_conn() as conn:
+        rows = conn.execute(
+            f"SELECT id, user_id, message_id, thread_id, sender, subject, snippet, "
+            f"status, action_taken, created_at, updated_at, {_SUMMARY_CLASSIFICATION_SQL} "
+            f"FROM review_queue WHERE user_id=? {status_filter}ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            (user_id, limit, offset),
+        ).fetchall()
+    items = []
+    for r in rows:
+        d = dict(r)
+        cls = {f: d.pop(f"cls_{f}") for f in _SUMMARY_CLASSIFICATION_FIELDS}
+        if cls["is_critical"] is not None:
+            cls["is_critical"] = bool(cls["is_critical"])  # JSON true comes back as 1
+        d["classification"] = {k: v for k, v in cls.items() if v is not None}
+        items.append(d)
+    return items
 
 
 def get_queue_item(user_id: str, item_id: int) -> Optional[dict]:
@@ -509,43 +719,172 @@ def get_queue_item(user_id: str, item_id: int) -> Optional[dict]:
 
 
 def update_queue_item(user_id: str, item_id: int, status: str, action_taken: Optional[str] = None):
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE review_queue SET status=?, action_taken=?, updated_at=? WHERE id=? AND user_id=?",
-            (status, action_taken, datetime.utcnow().isoformat(), item_id, user_id),
+            f"UPDATE review_queue SET status=?, action_taken=?, updated_at={NOW_SQL} WHERE id=? AND user_id=?",
+            (status, action_taken, item_id, user_id),
+        )
+
+
+def resolve_queue_item(
+    user_id: str,
+    item_id: int,
+    status: str,
+    action_taken: str,
+    event_type: str,
+    message: str,
+    from_status: str = "pending",
+) -> bool:
+    """
+    Move an item from from_status to status and log the event in one
+    transaction. Returns False (and logs nothing) if the item was no longer
+    in from_status.
+    """
+    # Buffered events go first, so the activity log keeps its order
+    flush_events()
+    with write_conn() as conn:
+        cur = conn.execute(
+            f"""UPDATE review_queue SET status=?, action_taken=?, updated_at={NOW_SQL}
+                WHERE id=? AND user_id=? AND status=?""",
+            (status, action_taken, item_id, user_id, from_status),
+        )
+        if cur.rowcount == 0:
+            return False
+        _insert_event(conn, user_id, event_type, message)
+    return True
+
+
+def claim_queue_item(user_id: str, item_id: int) -> bool:
+    """
+    Move a pending item to 'sending' before its Gmail call, so only one
+    request can act on it. Returns False if it was no longer pending.
+    """
+    with write_conn() as conn:
+        cur = conn.execute(
+            f"""UPDATE review_queue SET status='sending', updated_at={NOW_SQL}
+                WHERE id=? AND user_id=? AND status='pending'""",
+            (item_id, user_id),
+        )
+    return cur.rowcount > 0
+
+
+def release_queue_item(user_id: str, item_id: int) -> None:
+    """Put a claimed item back to pending after its Gmail call failed."""
+    with write_conn() as conn:
+        conn.execute(
+            f"""UPDATE review_queue SET status='pending', updated_at={NOW_SQL}
+                WHERE id=? AND user_id=? AND status='sending'""",
+            (item_id, user_id),
         )
-        conn.commit()
 
 
 def update_draft_reply(user_id: str, item_id: int, draft_reply: str):
-    with get_conn() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE review_queue SET draft_reply=?, updated_at=? WHERE id=? AND user_id=?",
-            (draft_reply, datetime.utcnow().isoformat(), item_id, user_id),
+            f"UPDATE review_queue SET draft_reply=?, updated_at={NOW_SQL} WHERE id=? AND user_id=?",
+            (draft_reply, item_id, user_id),
         )
-        conn.commit()
 
 
 # ── Activity log ───────────────────────────────────────────────────────────────
 
+# Trim each user's log to ACTIVITY_LOG_KEEP rows every ACTIVITY_PRUNE_EVERY inserts
+ACTIVITY_LOG_KEEP = 200
+ACTIVITY_PRUNE_EVERY = 100
+_log_counts: dict[str, int] = {}
+_log_counts_lock = threading.Lock()
+
+
+# log_event only buffers; a daemon thread writes the buffer every
+# EVENT_FLUSH_INTERVAL_SECONDS in one executemany, so a poll's several events
+# per email cost one commit instead of one each
+EVENT_FLUSH_INTERVAL_SECONDS = 0.5
+_event_buffer: list[tuple[str, str, str, str]] = []  # (user_id, type, message, created_at)
+_event_lock = threading.Lock()
+_event_flusher: Optional[threading.Thread] = None
+
+
 def log_event(user_id: str, event_type: str, message: str):
-    now = datetime.utcnow().isoformat()
-    with get_conn() as conn:
-        conn.execute(
-            "INSERT INTO activity_log (user_id, event_type, message, created_at) VALUES (?,?,?,?)",
-            (user_id, event_type, message, now),
-        )
-        # Keep only the 200 most recent events per user
+    global _event_flusher
+    row = (user_id, event_type, message, _utc_now())
+    with _event_lock:
+        _event_buffer.append(row)
+        if _event_flusher is None:
+            _event_flusher = threading.Thread(target=_flush_loop, name="event-flush", daemon=True)
+            _event_flusher.start()
+
+
+def flush_events() -> None:
+    """
+    Write any buffered events now (shutdown, and before reading the log), in
+    a transaction of their own. If the write fails the rows go back to the
+    front of the buffer for the next flush.
+    """
+    with _event_lock:
+        rows = _event_buffer[:]
+        _event_buffer.clear()
+    if not rows:
+        return
+    try:
+        with write_conn() as conn:
+            _insert_events(conn, rows)
+    except Exception:
+        with _event_lock:
+            _event_buffer[:0] = rows
+        raise
+
+
+def _flush_loop() -> None:
+    while True:
+        time.sleep(EVENT_FLUSH_INTERVAL_SECONDS)
+        try:
+            flush_events()
+        except Exception as e:
+            logger.error(f"Activity log flush failed: {e}")
+
+
+def _utc_now() -> str:
+    """Same format as NOW_SQL, taken when the event happens rather than when it's written."""
+    t = time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + f".{int(t % 1 * 1000):03d}"
+
+
+def _insert_event(conn: sqlite3.Connection, user_id: str, event_type: str, message: str) -> None:
+    """Append one activity row inside the caller's transaction."""
+    _insert_events(conn, [(user_id, event_type, message, _utc_now())])
+
+
+def _insert_events(conn: sqlite3.Connection, rows: list[tuple[str, str, str, str]]) -> None:
+    """
+    Insert rows in order, pruning users whose insert count crosses a
+    multiple of ACTIVITY_PRUNE_EVERY. Caller holds write_conn.
+    """
+    conn.executemany(
+        "INSERT INTO activity_log (user_id, event_type, message, created_at) VALUES (?,?,?,?)",
+        rows,
+    )
+
+    to_prune = []
+    with _log_counts_lock:
+        for uid, n in Counter(r[0] for r in rows).items():
+            before = _log_counts.get(uid, 0)
+            _log_counts[uid] = before + n
+            if (before + n) // ACTIVITY_PRUNE_EVERY > before // ACTIVITY_PRUNE_EVERY:
+                to_prune.append(uid)
+    for uid in to_prune:
+        # Everything older than the user's Nth most recent event; walks
+        # idx_activity_user (user_id, rowid) instead of a NOT IN anti-join
         conn.execute("""
             DELETE FROM activity_log
-            WHERE user_id=? AND id NOT IN (
-                SELECT id FROM activity_log WHERE user_id=? ORDER BY id DESC LIMIT 200
+            WHERE user_id=? AND id < (
+                SELECT id FROM activity_log WHERE user_id=?
+                ORDER BY id DESC LIMIT 1 OFFSET ?
             )
-        """, (user_id, user_id))
-        conn.commit()
+        """, (uid, uid, ACTIVITY_LOG_KEEP - 1))
 
 
 def get_recent_events(user_id: str, limit: int = 50) -> list[dict]:
+    flush_events()  # so the feed includes events from the last half second
     with get_conn() as conn:
         rows = conn.execute(
             "SELECT * FROM activity_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
@@ -556,11 +895,12 @@ def get_recent_events(user_id: str, limit: int = 50) -> list[dict]:
 
 # ── Internal helpers ───────────────────────────────────────────────────────────
 
-def _row_to_dict(row) -> dict:
+def _row_to_dict(row, parse_classification: bool = True) -> dict:
     d = dict(row)
-    if "classification" in d and d["classification"]:
+    raw = d.get("classification") if parse_classification else None
+    if raw:
         try:
-            d["classification"] = json.loads(d["classification"])
-        except Exception:
-            pass
+            d["classification"] = json.loads(raw)
+        except ValueError:
+            pass  # legacy non-JSON text: leave as-is
     return d
@@ -3,18 +3,60 @@ Draft email replies in Shankha's voice using Claude.
 Optionally injects calendar availability and GDrive attachment names.
 """
 
+import functools
+import hashlib
 import json
 import logging
-import os
+import re
+import threading
 import time
 from typing import Optional
 
-import anthropic
+from anthropic_client import get_client, truncate_tokens
 from config import load_config
 from params import load_params
 
 logger = logging.getLogger(__name__)
 
+# Token budgets for the latest email and the prior-thread context
+MAX_BODY_TOKENS = 500
+MAX_THREAD_TOKENS = 375
+
+# Identical requests within this window (re-sent nudges, the same email
+# landing in two threads) reuse the earlier draft instead of calling Claude
+DRAFT_CACHE_TTL_SECONDS = 600
+
+# request digest -> (monotonic time, draft)
+_draft_cache: dict[str, tuple[float, str]] = {}
+_draft_cache_lock = threading.Lock()
+
+_SPACES_RE = re.compile(r"[ \t\r\f\v]+")
+_BLANK_LINES_RE = re.compile(r"\n(?: ?\n)+")
+_QUOTE_PREFIX_RE = re.compile(r"^[>\s]+")
+
+# Thread lines shorter than this ("Thanks,", "Best") are kept even if the
+# latest email repeats them
+_MIN_DEDUPE_LINE = 20
+
+
+def _squeeze(text: str) -> str:
+    """Collapse space runs and blank-line runs left over from HTML/plain-text wrapping."""
+    return _BLANK_LINES_RE.sub("\n\n", _SPACES_RE.sub(" ", text)).strip()
+
+
+def _norm_line(line: str) -> str:
+    return _QUOTE_PREFIX_RE.sub("", line).rstrip().lower()
+
+
+def _dedupe_thread(thread_context: str, body: str) -> str:
+    """Drop thread-context lines the latest email already quotes."""
+    quoted = {_norm_line(line) for line in body.splitlines()}
+    return "\n".join(
+        line for line in thread_context.splitlines()
+        if len(line) < _MIN_DEDUPE_LINE or _norm_line(line) not in quoted
+    )
+
+
 def _build_drafter_prompt(params: dict) -> str:
     """Build the drafter system prompt from behavior_params.json."""
     identity = params.get("user_identity", {})
@@ -47,6 +89,12 @@ Rules:
 8. If calendar availability is provided and the sender proposes a specific meeting time, ONLY agree if that time falls within one of the listed free slots. If the proposed time is NOT in the free slots, say you are not free then and offer one or two of the listed slots instead"""
 
 
+@functools.lru_cache(maxsize=16)
+def _cached_drafter_prompt(params_json: str) -> str:
+    """Memoized prompt build — params are the same for every email in a poll."""
+    return _build_drafter_prompt(json.loads(params_json))
+
+
 def draft_reply(
     sender: str,
     subject: str,
@@ -64,9 +112,12 @@ def draft_reply(
         params = load_params()
     if model is None:
         model = load_config()["anthropic_model"]
-    system_prompt = _build_drafter_prompt(params)
+    system_prompt = _cached_drafter_prompt(json.dumps(params, sort_keys=True))
+    # Stable per user: let Anthropic reuse the cached prefix across emails
+    system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
 
-    # Append contact-specific tone instructions if available
+    # Append contact-specific tone instructions if available — as a separate
+    # block after the cache breakpoint so they don't invalidate the prefix
     if contact:
         rel  = contact.get("relationship_type", "")
         form = contact.get("formality_level", "")
@@ -84,9 +135,11 @@ def draft_reply(
         if topics_list:
             parts.append(f"Shared topics with this contact: {', '.join(topics_list)}.")
         if parts:
-            system_prompt += "\n\nContact context: " + " ".join(parts)
+            system.append({"type": "text", "text": "Contact context: " + " ".join(parts)})
 
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    # The SDK retries 408/409/429/5xx (including 529 overloaded) with
+    # exponential backoff + jitter, honoring Retry-After
+    client = get_client().with_options(max_retries=3)
 
     context_parts = []
     if calendar_slots:
@@ -96,9 +149,11 @@ def draft_reply(
 
     context_block = ("\n\n" + "\n\n".join(context_parts)) if context_parts else ""
 
+    body = _squeeze(body)
     thread_block = ""
     if thread_context:
-        thread_block = f"\n\nPrior conversation context (for reference only, do not repeat):\n{thread_context[:1500]}"
+        thread_context = _dedupe_thread(_squeeze(thread_context), body)
+        thread_block = f"\n\nPrior conversation context (for reference only, do not repeat):\n{truncate_tokens(thread_context, MAX_THREAD_TOKENS)}"
 
     user_prompt = f"""Draft a reply to the latest email in this thread:
 
@@ -107,31 +162,40 @@ Subject: {subject}
 Sender priority: {classification.get('sender_priority', 'unknown')}
 
 Latest email (reply to THIS one):
-{body[:2000]}
+{truncate_tokens(body, MAX_BODY_TOKENS)}
 {context_block}{thread_block}
 
 Write the reply body only. Reply to the latest email above, not to earlier messages in the thread.
 """
 
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = client.messages.create(
-                model=model,
-                max_tokens=1024,
-                system=system_prompt,
-                messages=[{"role": "user", "content": user_prompt}],
-            )
-            return response.content[0].text.strip()
-        except anthropic.APIStatusError as e:
-            if e.status_code == 529 and attempt < max_retries - 1:
-                wait = 10 * (attempt + 1)
-                logger.warning(f"Anthropic overloaded (529), retrying in {wait}s... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(wait)
-            else:
-                logger.error(f"Draft error after {attempt + 1} attempts: {e}")
-                return ""
-        except Exception as e:
-            logger.error(f"Draft error: {e}")
-            return ""
-    return ""
+    # Keyed on the full request, so persona, contact tone, calendar slots and
+    # attachments all have to match for a hit
+    cache_key = hashlib.blake2b(
+        json.dumps([model, system, user_prompt]).encode(), digest_size=16
+    ).hexdigest()
+    now = time.monotonic()
+    with _draft_cache_lock:
+        cached = _draft_cache.get(cache_key)
+    if cached and now - cached[0] < DRAFT_CACHE_TTL_SECONDS:
+        logger.info("Draft cache hit")
+        return cached[1]
+
+    try:
+        response = client.messages.create(
+            model=model,
+            max_tokens=1024,
+            system=system,
+            messages=[{"role": "user", "content": user_prompt}],
+        )
+        draft = response.content[0].text.strip()
+    except Exception as e:
+        logger.error(f"Draft error: {e}")
+        return ""
+
+    if draft:
+        now = time.monotonic()
+        with _draft_cache_lock:
+            for k in [k for k, (ts, _) in _draft_cache.items() if now - ts >= DRAFT_CACHE_TTL_SECONDS]:
+                del _draft_cache[k]
+            _draft_cache[cache_key] = (now, draft)
+    return draft
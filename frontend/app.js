@@ -121,6 +121,7 @@ function renderCard(email) {
 
   const badges = [];
   if (email.status === 'pending') badges.push(`<span class="badge badge-pending">REVIEW</span>`);
+  if (email.status === 'sending') badges.push(`<span class="badge badge-sending">SENDING</span>`);
   if (email.status === 'sent') badges.push(`<span class="badge badge-sent">SENT</span>`);
   if (email.status === 'drafted') badges.push(`<span class="badge badge-drafted">DRAFTED</span>`);
   if (email.status === 'discarded') badges.push(`<span class="badge badge-discarded">DISCARDED</span>`);
@@ -222,6 +223,8 @@ function renderModal(item) {
       <button class="btn-to-draft" onclick="takeAction(${item.id}, 'draft')">Save to Drafts</button>
       <button class="btn-send" onclick="takeAction(${item.id}, 'send')">Send</button>
     `;
+  } else if (item.status === 'sending') {
+    actionsEl.innerHTML = `<span class="mono" style="font-size:11px;color:var(--text-dimmer)">// sending… returns to pending if it doesn't complete</span>`;
   } else {
     actionsEl.innerHTML = `<span class="mono" style="font-size:11px;color:var(--text-dimmer)">// ${item.action_taken || item.status}</span>`;
   }
@@ -367,6 +370,7 @@ const EVENT_META = {
   poll_start:      { glyph: '⟳', color: 'var(--text-dimmer)' },
   poll_end:        { glyph: '✓', color: 'var(--green)' },
   classified:      { glyph: '◆', color: 'var(--accent)' },
+  fast_path:       { glyph: '◇', color: 'var(--text-dimmer)' },
   drive_fetched:   { glyph: '⊕', color: 'var(--accent)' },
   calendar_checked:{ glyph: '◷', color: 'var(--accent)' },
   drafted:         { glyph: '✦', color: 'var(--yellow)' },
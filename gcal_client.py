@@ -4,11 +4,33 @@ Only called when classifier detects a meeting scheduling request.
 """
 
 import logging
+import threading
+import time
+import zoneinfo
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# Busy periods are reused for this long, so several scheduling emails in one
+# poll share a single calendarList + freebusy round trip
+FREEBUSY_TTL_SECONDS = 180
+
+# user_id -> (monotonic fetch time, timeMax the fetch covered, busy periods)
+_busy_cache: dict[str, tuple[float, datetime, list[dict]]] = {}
+
+# Per-user locks so concurrent emails that miss the cache together make one
+# fetch; the rest wait for it and read the fresh entry
+_fetch_locks: dict[str, threading.Lock] = {}
+_fetch_locks_mutex = threading.Lock()
+
+
+def _get_fetch_lock(user_id: str) -> threading.Lock:
+    with _fetch_locks_mutex:
+        if user_id not in _fetch_locks:
+            _fetch_locks[user_id] = threading.Lock()
+        return _fetch_locks[user_id]
+
 
 def get_free_slots(
     service,
@@ -16,33 +38,37 @@ def get_free_slots(
     work_start: int = 8,
     work_end: int = 18,
     tz_name: str = "America/Chicago",
+    user_id: Optional[str] = None,
 ) -> str:
     """
     Returns a human-readable string of free slots for the next N days
     during working hours, formatted naturally for email insertion.
     tz_name: IANA timezone for the user (default: America/Chicago for Shankha).
+    user_id: when given, busy periods are cached per user for FREEBUSY_TTL_SECONDS.
     """
-    import zoneinfo
     user_tz = zoneinfo.ZoneInfo(tz_name)
     now = datetime.now(user_tz)
+    window_end = now + timedelta(days=days_ahead)
     time_min = now.isoformat()
-    time_max = (now + timedelta(days=days_ahead)).isoformat()
+    time_max = window_end.isoformat()
 
     try:
-        # Discover all calendars the user has connected (primary + any linked accounts)
-        cal_list = service.calendarList().list().execute()
-        calendar_ids = [c["id"] for c in cal_list.get("items", [])] or ["primary"]
-
-        result = service.freebusy().query(body={
-            "timeMin": time_min,
-            "timeMax": time_max,
-            "items": [{"id": cid} for cid in calendar_ids],
-        }).execute()
-
-        # Merge busy blocks from every calendar so none are missed
-        busy_periods = []
-        for cid in calendar_ids:
-            busy_periods.extend(result["calendars"].get(cid, {}).get("busy", []))
+        if user_id:
+            with _get_fetch_lock(user_id):
+                # A cached fetch can be reused only if it reached at least as far
+                # as this window; comparing day counts would leave the last
+                # minutes since that fetch unchecked
+                cached = _busy_cache.get(user_id)
+                if cached and time.monotonic() - cached[0] < FREEBUSY_TTL_SECONDS and cached[1] >= window_end:
+                    busy_periods = cached[2]
+                else:
+                    # Fetched one TTL past the window, so same-length windows
+                    # requested while the entry is fresh are still covered
+                    fetch_end = window_end + timedelta(seconds=FREEBUSY_TTL_SECONDS)
+                    busy_periods = _fetch_busy_periods(service, time_min, fetch_end.isoformat())
+                    _busy_cache[user_id] = (time.monotonic(), fetch_end, busy_periods)
+        else:
+            busy_periods = _fetch_busy_periods(service, time_min, time_max)
 
         free_slots = _compute_free_slots(now, days_ahead, busy_periods, work_start, work_end)
         result_str = _format_free_slots(free_slots)
@@ -54,6 +80,25 @@ def get_free_slots(
         return ""
 
 
+def _fetch_busy_periods(service, time_min: str, time_max: str) -> list[dict]:
+    """Busy blocks across every calendar the user has connected."""
+    # Discover all calendars the user has connected (primary + any linked accounts)
+    cal_list = service.calendarList().list().execute()
+    calendar_ids = [c["id"] for c in cal_list.get("items", [])] or ["primary"]
+
+    result = service.freebusy().query(body={
+        "timeMin": time_min,
+        "timeMax": time_max,
+        "items": [{"id": cid} for cid in calendar_ids],
+    }).execute()
+
+    # Merge busy blocks from every calendar so none are missed
+    busy_periods = []
+    for cid in calendar_ids:
+        busy_periods.extend(result["calendars"].get(cid, {}).get("busy", []))
+    return busy_periods
+
+
 def _compute_free_slots(
     now: datetime,
     days_ahead: int,
@@ -64,6 +109,20 @@ def _compute_free_slots(
     """Compute free windows within working hours given busy periods."""
     free = []
     local_now = now  # now is already in user_tz
+    tz = local_now.tzinfo
+
+    # Parse and convert each busy period once, sorted by start
+    busy = sorted(
+        (
+            datetime.fromisoformat(b["start"].replace("Z", "+00:00")).astimezone(tz),
+            datetime.fromisoformat(b["end"].replace("Z", "+00:00")).astimezone(tz),
+        )
+        for b in busy_periods
+    )
+    # Sweep: periods join `active` once they've started and drop out once
+    # they've ended, so each day only looks at the periods touching it
+    active: list[tuple[datetime, datetime]] = []
+    next_busy = 0
 
     for day_offset in range(days_ahead):
         day = (local_now + timedelta(days=day_offset)).date()
@@ -78,14 +137,12 @@ def _compute_free_slots(
         if day_start < local_now:
             day_start = local_now
 
-        # Build busy windows for this day
-        day_busy = []
-        for b in busy_periods:
-            b_start = datetime.fromisoformat(b["start"].replace("Z", "+00:00")).astimezone(local_now.tzinfo)
-            b_end = datetime.fromisoformat(b["end"].replace("Z", "+00:00")).astimezone(local_now.tzinfo)
-            if b_start.date() <= day <= b_end.date():
-                day_busy.append((b_start, b_end))
-        day_busy.sort(key=lambda x: x[0])
+        # Build busy windows for this day (already in start order)
+        while next_busy < len(busy) and busy[next_busy][0].date() <= day:
+            active.append(busy[next_busy])
+            next_busy += 1
+        active = [(b_start, b_end) for b_start, b_end in active if b_end.date() >= day]
+        day_busy = active
 
         # Walk through the day finding free windows >= 30 minutes
         cursor = day_start
@@ -112,7 +169,9 @@ def _format_free_slots(slots: list[dict]) -> str:
     lines = []
     by_day: dict = {}
     for slot in slots:
-        day_key = slot["start"].strftime("%-m/%-d")
+        start = slot["start"]
+        # f-string rather than strftime("%-m/%-d"), which isn't portable
+        day_key = f"{start.month}/{start.day}"
         if day_key not in by_day:
             by_day[day_key] = []
         by_day[day_key].append(slot)
@@ -128,12 +187,16 @@ def _format_free_slots(slots: list[dict]) -> str:
     return "\n".join(lines)
 
 
+# On-the-hour labels, the common case: 0 -> "12am", 13 -> "1pm"
+_HOUR_LABELS = [f"{h % 12 or 12}{'am' if h < 12 else 'pm'}" for h in range(24)]
+
+
 def _fmt_time(dt: datetime) -> str:
     """Format like 12pm, 10:30am."""
     h = dt.hour
     m = dt.minute
+    if m == 0:
+        return _HOUR_LABELS[h]
     period = "am" if h < 12 else "pm"
     h12 = h % 12 or 12
-    if m == 0:
-        return f"{h12}{period}"
     return f"{h12}:{m:02d}{period}"
@@ -5,10 +5,32 @@ Only called when classifier detects a document request (resume, proposal, etc).
 
 import io
 import logging
+import threading
+import time
 from typing import Optional
 
+from googleapiclient.http import MediaIoBaseDownload
+
 logger = logging.getLogger(__name__)
 
+# Search results and downloaded files are reused for this long, so several
+# emails in one poll asking for the same document cost one search + download
+DRIVE_CACHE_TTL_SECONDS = 300
+
+# (user_id, lowercased query) -> (monotonic time, files)
+_search_cache: dict[tuple[str, str], tuple[float, list[dict]]] = {}
+# (user_id, file_id, modifiedTime) -> (monotonic time, attachment dict)
+_download_cache: dict[tuple[str, str, str], tuple[float, dict]] = {}
+_cache_lock = threading.Lock()
+
+# Per-user locks around cache misses: concurrent emails asking for the same
+# document make one search + download, the rest wait and hit the cache
+_fetch_locks: dict[str, threading.Lock] = {}
+_fetch_locks_mutex = threading.Lock()
+
+# Ranged GET size for downloads; most attachments fit in a single chunk
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
 # MIME types we can handle as attachments
 EXPORTABLE_MIME = {
     "application/vnd.google-apps.document": (
@@ -26,100 +48,169 @@ EXPORTABLE_MIME = {
 }
 
 
-def search_and_attach(service, query: str) -> list[dict]:
+def search_and_attach(service, query: str, user_id: Optional[str] = None) -> list[dict]:
     """
     Search Drive for files matching the query, return the best match(es)
     as attachment dicts: {filename, data (bytes), mime_type}.
-    Tries name-based search first (more precise), falls back to full-text search.
+    Name matches (more precise) win over full-text-only matches.
     Returns empty list on failure or no results.
+    user_id: when given, searches and downloads are cached per user for
+    DRIVE_CACHE_TTL_SECONDS.
     """
-    safe_q = _sanitize(query)
     try:
-        files = []
-        for q in [
-            f"name contains '{safe_q}' and trashed=false",
-            f"fullText contains '{safe_q}' and trashed=false",
-        ]:
-            results = service.files().list(
-                q=q,
-                spaces="drive",
-                fields="files(id, name, mimeType, modifiedTime)",
-                orderBy="modifiedTime desc",
-                pageSize=3,
-            ).execute()
-            files = results.get("files", [])
-            if files:
-                break  # found by name — don't fall through to content search
-
-        if not files:
-            logger.info(f"No Drive files found for query: {query}")
-            return []
+        if user_id:
+            with _get_fetch_lock(user_id):
+                return _search_and_download(service, query, user_id)
+        return _search_and_download(service, query, None)
+
+    except Exception as e:
+        logger.error(f"Drive search error: {e}")
+        return []
+
+
+def _search_and_download(service, query: str, user_id: Optional[str]) -> list[dict]:
+    files = _search_files(service, query, user_id)
+    if not files:
+        logger.info(f"No Drive files found for query: {query}")
+        return []
+
+    attachments = []
+    for f in files[:1]:  # attach only the best match
+        att = _download_file(service, f, user_id)
+        if att:
+            attachments.append(att)
+    return attachments
 
+
+def download_files(service, files: list[dict], user_id: Optional[str] = None) -> list[dict]:
+    """
+    Attachment dicts for Drive files already chosen by search_and_attach
+    (their "drive_file" metadata), skipping the search. Files that fail to
+    download are left out.
+    """
+    try:
         attachments = []
-        for f in files[:1]:  # attach only the best match
-            att = _download_file(service, f)
+        for f in files:
+            att = _download_file(service, f, user_id)
             if att:
                 attachments.append(att)
-
         return attachments
-
     except Exception as e:
-        logger.error(f"Drive search error: {e}")
+        logger.error(f"Drive download error: {e}")
         return []
 
 
-def _download_file(service, file_meta: dict) -> Optional[dict]:
+def _get_fetch_lock(user_id: str) -> threading.Lock:
+    with _fetch_locks_mutex:
+        if user_id not in _fetch_locks:
+            _fetch_locks[user_id] = threading.Lock()
+        return _fetch_locks[user_id]
+
+
+def _download_file(service, file_meta: dict, user_id: Optional[str] = None) -> Optional[dict]:
     file_id = file_meta["id"]
     name = file_meta["name"]
     mime = file_meta["mimeType"]
 
+    # Keyed on modifiedTime so an edited file is fetched again
+    key = (user_id, file_id, file_meta.get("modifiedTime", ""))
+    cached = _cache_get(_download_cache, key) if user_id else None
+    if cached is not None:
+        return cached
+
     try:
         if mime in EXPORTABLE_MIME:
             export_mime, ext = EXPORTABLE_MIME[mime]
-            data = service.files().export_media(
-                fileId=file_id, mimeType=export_mime
-            ).execute()
+            request = service.files().export_media(fileId=file_id, mimeType=export_mime)
             filename = name + ext
         else:
-            data = service.files().get_media(fileId=file_id).execute()
+            request = service.files().get_media(fileId=file_id)
             filename = name
+        data = _fetch_media(request)
 
-        return {
+        att = {
             "filename": filename,
             "data": data,
             "mime_type": mime,
+            # Drive metadata, so a queued reply can re-fetch this exact file later
+            "drive_file": {k: file_meta[k] for k in ("id", "name", "mimeType", "modifiedTime") if k in file_meta},
         }
+        if user_id:
+            _cache_put(_download_cache, key, att)
+        return att
     except Exception as e:
         logger.error(f"Error downloading file {name}: {e}")
         return None
 
 
+def _fetch_media(request) -> bytes:
+    """Download a media request in DOWNLOAD_CHUNK_SIZE ranges; a failed chunk is retried alone."""
+    buf = io.BytesIO()
+    downloader = MediaIoBaseDownload(buf, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk(num_retries=2)
+    return buf.getvalue()
+
+
+# Enough full-text hits that a name match isn't crowded out of the page
+SEARCH_PAGE_SIZE = 20
+
+
+def _search_files(service, query: str, user_id: Optional[str] = None) -> list[dict]:
+    """
+    One Drive query matching by name or content, newest first, with name
+    matches moved ahead of content-only matches (stable, so each group
+    stays in modifiedTime order).
+    """
+    key = (user_id, query.lower())
+    cached = _cache_get(_search_cache, key) if user_id else None
+    if cached is not None:
+        return cached
+
+    safe_q = _sanitize(query)
+    results = service.files().list(
+        q=f"(name contains '{safe_q}' or fullText contains '{safe_q}') and trashed=false",
+        spaces="drive",
+        fields="files(id, name, mimeType, modifiedTime)",
+        orderBy="modifiedTime desc",
+        pageSize=SEARCH_PAGE_SIZE,
+    ).execute()
+    needle = query.lower()
+    files = sorted(results.get("files", []), key=lambda f: needle not in f["name"].lower())
+    if user_id:
+        _cache_put(_search_cache, key, files)
+    return files
+
+
+def _cache_get(cache: dict, key: tuple):
+    with _cache_lock:
+        entry = cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < DRIVE_CACHE_TTL_SECONDS:
+        return entry[1]
+    return None
+
+
+def _cache_put(cache: dict, key: tuple, value) -> None:
+    """Store value, evicting expired entries so cached downloads don't pile up."""
+    now = time.monotonic()
+    with _cache_lock:
+        for k in [k for k, (ts, _) in cache.items() if now - ts >= DRIVE_CACHE_TTL_SECONDS]:
+            del cache[k]
+        cache[key] = (now, value)
+
+
 def _sanitize(query: str) -> str:
     """Escape single quotes for Drive API query."""
     return query.replace("'", "\\'")
 
 
-def get_attachment_names(service, query: str) -> list[str]:
+def get_attachment_names(service, query: str, user_id: Optional[str] = None) -> list[str]:
     """
     Quick search to get just filenames (for drafter context without downloading).
-    Tries name-based search first, falls back to full-text search.
+    Name matches win over full-text-only matches.
     """
-    safe_q = _sanitize(query)
     try:
-        for q in [
-            f"name contains '{safe_q}' and trashed=false",
-            f"fullText contains '{safe_q}' and trashed=false",
-        ]:
-            results = service.files().list(
-                q=q,
-                spaces="drive",
-                fields="files(id, name, mimeType)",
-                orderBy="modifiedTime desc",
-                pageSize=3,
-            ).execute()
-            files = results.get("files", [])
-            if files:
-                return [f["name"] for f in files][:1]
-        return []
+        return [f["name"] for f in _search_files(service, query, user_id)[:1]]
     except Exception:
         return []
@@ -4,70 +4,163 @@ All functions accept a pre-built service object as the first parameter.
 """
 
 import base64
+import html
+import io
 import logging
+import re
 import time
-from email import encoders
-from email.mime.base import MIMEBase
+from email.generator import BytesGenerator
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Optional
+from typing import Iterator, Optional
+
+from googleapiclient.errors import HttpError
 
 logger = logging.getLogger(__name__)
 
 # Labels to skip - automated/promotional senders
-SKIP_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_UPDATES", "CATEGORY_FORUMS"}
+SKIP_LABELS = frozenset({"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_UPDATES", "CATEGORY_FORUMS"})
 
+# HTML-to-text: drop script/style contents, then tags, then squeeze whitespace
+_HIDDEN_RE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.S | re.I)
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
 
-def fetch_unread_emails(service, max_results: int = 20, after_epoch: int = None) -> list[dict]:
-    """Fetch unread emails from inbox received after after_epoch (unix timestamp)."""
-    try:
-        q = "is:unread in:inbox -category:promotions -category:social -category:updates"
-        if after_epoch:
-            q += f" after:{after_epoch}"
-        fetch_limit = max(max_results * 3, 50)
-        result = service.users().messages().list(
-            userId="me",
-            q=q,
-            maxResults=fetch_limit,
-        ).execute()
+# Partial-response masks: only what _parse_message / _extract_thread_context
+# read, dropping sizeEstimate, historyId, internalDate, attachment ids etc.
+MESSAGE_FIELDS = "id,threadId,labelIds,snippet,payload(mimeType,filename,headers,body/data,parts)"
+HEADER_FIELDS = "id,snippet,payload/headers"
 
-        messages = result.get("messages", [])
-        emails = []
-        seen_threads = set()
+# Requests per Gmail batch call; Google advises staying at or under 50
+BATCH_SIZE = 50
 
-        for msg in messages:
-            quick = service.users().messages().get(
-                userId="me", id=msg["id"], format="metadata",
-                metadataHeaders=["From", "Subject"]
-            ).execute()
 
-            thread_id = quick.get("threadId")
-            if thread_id in seen_threads:
-                continue
-            seen_threads.add(thread_id)
+def batch_execute(service, requests: list) -> list[Optional[dict]]:
+    """
+    Execute API requests via batch HTTP calls (one round trip per BATCH_SIZE
+    requests). Returns responses in request order; failed requests are
+    logged and come back as None.
+    """
+    return [response for chunk in iter_batches(service, requests) for response in chunk]
 
-            thread = service.users().threads().get(
-                userId="me", id=thread_id, format="full"
-            ).execute()
 
+def iter_batches(service, requests: list) -> Iterator[list[Optional[dict]]]:
+    """
+    batch_execute, one BATCH_SIZE chunk at a time: each chunk's responses
+    are yielded as soon as its round trip returns, before the next is sent.
+    """
+    for start in range(0, len(requests), BATCH_SIZE):
+        chunk = requests[start:start + BATCH_SIZE]
+        responses: list[Optional[dict]] = [None] * len(chunk)
+
+        def _callback(request_id, response, exception):
+            if exception is not None:
+                logger.warning(f"Batched Gmail request failed: {exception}")
+            else:
+                responses[int(request_id)] = response
+
+        batch = service.new_batch_http_request(callback=_callback)
+        for i, request in enumerate(chunk):
+            batch.add(request, request_id=str(i))
+        batch.execute()
+        yield responses
+
+
+def list_unread_threads(
+    service, max_results: int = 20, after_epoch: int = None,
+) -> tuple[list[str], bool]:
+    """
+    Thread ids of unread inbox mail received after after_epoch (unix
+    timestamp), newest first, one per thread. Also returns whether the
+    listing was truncated (hit its limit or had another page), i.e. older
+    unread mail may not be in it. API errors propagate.
+    """
+    q = "is:unread in:inbox -category:promotions -category:social -category:updates"
+    if after_epoch:
+        q += f" after:{after_epoch}"
+    fetch_limit = max(max_results * 3, 50)
+    result = service.users().messages().list(
+        userId="me",
+        q=q,
+        maxResults=fetch_limit,
+    ).execute()
+
+    # list() already returns each message's threadId; keep the first
+    # (newest) hit per thread, in list order
+    messages = result.get("messages", [])
+    truncated = bool(result.get("nextPageToken")) or len(messages) >= fetch_limit
+    return list(dict.fromkeys(msg["threadId"] for msg in messages)), truncated
+
+
+def fetch_unread_emails(service, thread_ids: list[str]) -> Iterator[dict]:
+    """
+    Yield the latest message of each listed thread (see list_unread_threads)
+    as a parsed email. Emails come out as each thread batch returns, so the
+    caller can start on the first batch while later ones download. A failed
+    thread fetch is logged and skipped; a failed batch round trip propagates
+    from the iteration.
+    """
+    requests = [
+        service.users().threads().get(
+            userId="me", id=thread_id, format="full",
+            fields=f"messages({MESSAGE_FIELDS})",
+        )
+        for thread_id in thread_ids
+    ]
+
+    for threads in iter_batches(service, requests):
+        for thread in threads:
+            if thread is None:
+                continue
             thread_messages = thread.get("messages", [])
             if not thread_messages:
                 continue
 
             detail = thread_messages[-1]
-            last_labels = set(detail.get("labelIds", []))
-            if last_labels & SKIP_LABELS:
+            if not SKIP_LABELS.isdisjoint(detail.get("labelIds", ())):
                 continue
 
             parsed = _parse_message(detail)
             if parsed:
                 parsed["thread_context"] = _extract_thread_context(thread_messages[:-1])
-                emails.append(parsed)
+                yield parsed
 
-        return emails
+
+def get_history_id(service) -> Optional[str]:
+    """The mailbox's current historyId, or None if the profile call fails."""
+    try:
+        profile = service.users().getProfile(userId="me", fields="historyId").execute()
+        return profile.get("historyId")
     except Exception as e:
-        logger.error(f"Error fetching emails: {e}")
-        return []
+        logger.warning(f"Error reading Gmail historyId: {e}")
+        return None
+
+
+def inbox_changed_since(service, start_history_id: str) -> Optional[bool]:
+    """
+    Whether any message has been added to the inbox after start_history_id.
+    One history.list call, which comes back empty for an idle mailbox.
+    Returns None if Gmail can't answer (404: history that old has expired)
+    and the caller should fall back to a full listing.
+    """
+    try:
+        result = service.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            labelId="INBOX",
+            maxResults=1,
+            fields="history/id",
+        ).execute()
+    except HttpError as e:
+        if e.resp.status != 404:
+            logger.warning(f"Error listing Gmail history: {e}")
+        return None
+    except Exception as e:
+        logger.warning(f"Error listing Gmail history: {e}")
+        return None
+    return bool(result.get("history"))
 
 
 def fetch_sent_emails(
@@ -88,13 +181,27 @@ def fetch_sent_emails(
             maxResults=max_results,
         ).execute()
         messages = result.get("messages", [])
+        if headers_only:
+            requests = [
+                service.users().messages().get(
+                    userId="me", id=msg["id"], format="metadata",
+                    metadataHeaders=["To", "Subject"], fields=HEADER_FIELDS,
+                )
+                for msg in messages
+            ]
+        else:
+            requests = [
+                service.users().messages().get(
+                    userId="me", id=msg["id"], format="full", fields=MESSAGE_FIELDS,
+                )
+                for msg in messages
+            ]
+
         emails = []
-        for msg in messages:
+        for detail in batch_execute(service, requests):
+            if detail is None:
+                continue
             if headers_only:
-                detail = service.users().messages().get(
-                    userId="me", id=msg["id"], format="metadata",
-                    metadataHeaders=["To", "Subject"]
-                ).execute()
                 headers = {h["name"]: h["value"] for h in detail["payload"].get("headers", [])}
                 emails.append({
                     "id": detail["id"],
@@ -103,9 +210,6 @@ def fetch_sent_emails(
                     "snippet": detail.get("snippet", ""),
                 })
             else:
-                detail = service.users().messages().get(
-                    userId="me", id=msg["id"], format="full"
-                ).execute()
                 parsed = _parse_message(detail)
                 if parsed:
                     emails.append(parsed)
@@ -151,28 +255,55 @@ def _parse_message(detail: dict) -> Optional[dict]:
         "snippet": detail.get("snippet", ""),
         "body": body[:4000],
         "has_attachments": _has_attachments(detail["payload"]),
+        "auto_submitted": _is_auto_submitted(headers),
+        "list_mail": _is_list_mail(headers),
     }
 
 
+def _is_auto_submitted(headers: dict) -> bool:
+    """
+    True if the message's own headers mark it machine-sent: Auto-Submitted
+    (auto-replies, notifications; RFC 3834 says not to answer these) or
+    bulk/junk Precedence.
+    """
+    if headers.get("Auto-Submitted", "no").strip().lower() != "no":
+        return True
+    return headers.get("Precedence", "").strip().lower() in ("bulk", "junk")
+
+
+def _is_list_mail(headers: dict) -> bool:
+    """True if the message came through a mailing list or newsletter tool (List-Unsubscribe, Precedence: list)."""
+    if headers.get("List-Unsubscribe"):
+        return True
+    return headers.get("Precedence", "").strip().lower() == "list"
+
+
 def _extract_body(payload: dict) -> str:
-    if payload.get("mimeType") == "text/plain":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            return base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-
-    if payload.get("mimeType") == "text/html":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            import re
-            text = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-            return re.sub(r"<[^>]+>", " ", text)
+    """
+    Body text of a message: the first text/plain part in MIME order, else
+    the first text/html part converted to text. Only the chosen part is decoded.
+    """
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("body", {}).get("data"):
+            mime = part.get("mimeType")
+            if mime == "text/plain":
+                return _decode_part(part)
+            if mime == "text/html" and html_part is None:
+                html_part = part
+        # Reversed so parts pop in document order
+        stack.extend(reversed(part.get("parts", [])))
+
+    if html_part is None:
+        return ""
+    text = _TAG_RE.sub(" ", _HIDDEN_RE.sub(" ", _decode_part(html_part)))
+    return _WS_RE.sub(" ", html.unescape(text)).strip()
 
-    for part in payload.get("parts", []):
-        result = _extract_body(part)
-        if result:
-            return result
 
-    return ""
+def _decode_part(part: dict) -> str:
+    return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="replace")
 
 
 def _has_attachments(payload: dict) -> bool:
@@ -239,24 +370,22 @@ def _build_message(
         mime = MIMEMultipart()
         mime.attach(MIMEText(body, "plain"))
         for att in attachments:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(att["data"])
-            encoders.encode_base64(part)
+            # MIMEApplication base64-encodes the payload once, on construction
+            part = MIMEApplication(att["data"], "octet-stream")
             part.add_header(
                 "Content-Disposition",
                 f'attachment; filename="{att["filename"]}"',
             )
             mime.attach(part)
-        mime["to"] = to
-        mime["subject"] = subject
-        raw = base64.urlsafe_b64encode(mime.as_bytes()).decode()
     else:
         mime = MIMEText(body, "plain")
-        mime["to"] = to
-        mime["subject"] = subject
-        raw = base64.urlsafe_b64encode(mime.as_bytes()).decode()
+    mime["to"] = to
+    mime["subject"] = subject
 
-    return {"raw": raw}
+    # The Gmail API takes the whole RFC 822 message base64url-encoded in `raw`
+    buf = io.BytesIO()
+    BytesGenerator(buf).flatten(mime)
+    return {"raw": base64.urlsafe_b64encode(buf.getvalue()).decode()}
 
 
 def mark_as_read(service, message_id: str):
@@ -2,26 +2,33 @@
 FastAPI backend for Gmail Replier — multi-user.
 """
 
+import asyncio
+import functools
+import hashlib
 import logging
 import os
 import re
 import secrets
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from pathlib import Path
+from typing import Annotated, Literal, Optional
 
 from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from jose import JWTError, jwt
+import jwt
 from pydantic import BaseModel, Field
 
 import auth
+import background_setup
 import database as db
 import scheduler
-from gdrive_client import search_and_attach
+from gdrive_client import download_files, search_and_attach
 from gmail_client import create_reply_draft, send_reply
 
 logging.basicConfig(
@@ -35,16 +42,47 @@ JWT_SECRET = os.environ.get("JWT_SECRET_KEY", "dev-secret-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRE_DAYS = 30
 COOKIE_NAME = "session"
+# Mark the session cookie Secure when the app is served over https
+COOKIE_SECURE = os.environ.get("APP_BASE_URL", "").startswith("https")
 
 # ── In-flight OAuth flows: state -> (Flow, created_at unix ts) ─────────────────
+# Insertion order is age order, so expiry only ever looks at the oldest entries
+OAUTH_FLOW_TTL_SECONDS = 600
+OAUTH_FLOW_MAX = 1000
 _oauth_flows: dict[str, tuple] = {}
+_oauth_flows_lock = threading.Lock()
 
 
-def _cleanup_stale_flows():
-    cutoff = time.time() - 600  # 10 minutes
-    stale = [s for s, (_, ts) in list(_oauth_flows.items()) if ts < cutoff]
-    for s in stale:
-        del _oauth_flows[s]
+def _store_flow(state: str, flow) -> None:
+    """Remember a flow, dropping expired ones and the oldest beyond OAUTH_FLOW_MAX."""
+    now = time.time()
+    with _oauth_flows_lock:
+        while _oauth_flows:
+            oldest = next(iter(_oauth_flows))
+            if (len(_oauth_flows) < OAUTH_FLOW_MAX
+                    and now - _oauth_flows[oldest][1] < OAUTH_FLOW_TTL_SECONDS):
+                break
+            del _oauth_flows[oldest]
+        _oauth_flows[state] = (flow, now)
+
+
+def _pop_flow(state: str):
+    """Take the flow for state, or None if it is unknown or expired."""
+    with _oauth_flows_lock:
+        entry = _oauth_flows.pop(state, None)
+    if entry is None or time.time() - entry[1] >= OAUTH_FLOW_TTL_SECONDS:
+        return None
+    return entry[0]
+
+
+# Drive downloads for take_action, overlapped with building the Gmail client.
+# API clients are per-thread (see auth._get_service), so each side builds its own.
+_action_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="action")
+
+
+# Running background_setup tasks; the event loop only holds weak references,
+# so without this a setup could be garbage-collected mid-run
+_setup_tasks: set[asyncio.Task] = set()
 
 
 # ── Lifespan ───────────────────────────────────────────────────────────────────
@@ -53,13 +91,13 @@ def _cleanup_stale_flows():
 async def lifespan(app: FastAPI):
     db.init_db()
     scheduler.init_scheduler()
-    for uid in db.get_all_users_with_tokens():
-        try:
-            scheduler.add_user_job(uid)
-        except Exception as e:
-            logger.warning(f"Could not re-add job for {uid}: {e}")
+    scheduler.add_all_user_jobs()
     yield
+    for task in _setup_tasks:
+        task.cancel()
     scheduler.shutdown_scheduler()
+    _action_pool.shutdown(wait=False)
+    db.flush_events()
 
 
 app = FastAPI(title="Gmail Replier", lifespan=lifespan)
@@ -74,9 +112,21 @@ app.add_middleware(
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
 
+@functools.lru_cache(maxsize=1)
+def _index_page() -> tuple[bytes, str]:
+    """index.html and its ETag, read once: the page only changes on deploy."""
+    body = Path("frontend/index.html").read_bytes()
+    return body, '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
 @app.get("/")
-def index():
-    return FileResponse("frontend/index.html")
+async def index(request: Request):
+    body, etag = _index_page()
+    # no-cache: browsers revalidate every load and get a 304 while it's unchanged
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="text/html", headers=headers)
 
 
 # ── JWT helpers ────────────────────────────────────────────────────────────────
@@ -90,19 +140,54 @@ def create_session_token(user_id: str) -> str:
     )
 
 
-def get_current_user(request: Request) -> str:
-    """FastAPI dependency — returns user_id or raises 401."""
+# Verified sessions: blake2b(token) -> (sub, exp unix ts, cached_at). Skips
+# the HMAC check + JSON decode on the dashboard's back-to-back API calls.
+SESSION_CACHE_TTL_SECONDS = 60
+SESSION_CACHE_MAX = 10_000
+_session_cache: dict[bytes, tuple[str, float, float]] = {}
+_session_cache_lock = threading.Lock()
+
+
+def _decode_session(token: str) -> Optional[str]:
+    """Return the token's user_id (sub), or None if it is invalid or expired."""
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    with _session_cache_lock:
+        entry = _session_cache.get(key)
+    if entry is not None and now < entry[1] and now - entry[2] < SESSION_CACHE_TTL_SECONDS:
+        return entry[0]
+
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    user_id = payload.get("sub")
+    if not user_id:
+        return None
+    with _session_cache_lock:
+        if len(_session_cache) >= SESSION_CACHE_MAX:
+            _session_cache.clear()
+        _session_cache[key] = (user_id, float(payload.get("exp", now)), now)
+    return user_id
+
+
+async def get_current_user(request: Request) -> str:
+    """
+    FastAPI dependency — returns user_id or raises 401.
+    async: it never blocks, so it runs on the event loop instead of taking a
+    threadpool slot ahead of every endpoint.
+    """
     token = request.cookies.get(COOKIE_NAME)
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return user_id
-    except JWTError:
+    user_id = _decode_session(token)
+    if not user_id:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return user_id
+
+
+# Endpoint parameter for the signed-in user's id
+CurrentUser = Annotated[str, Depends(get_current_user)]
 
 
 # ── Auth endpoints ─────────────────────────────────────────────────────────────
@@ -111,10 +196,9 @@ def get_current_user(request: Request) -> str:
 @app.get("/auth")   # backward-compat alias
 def start_auth():
     """Redirect to Google OAuth consent screen."""
-    _cleanup_stale_flows()
-    state = secrets.token_urlsafe(32)
+    state = secrets.token_urlsafe(16)  # 128 bits: plenty for a 10-minute CSRF state
     flow = auth.create_oauth_flow()
-    _oauth_flows[state] = (flow, time.time())
+    _store_flow(state, flow)
     auth_url, _ = flow.authorization_url(
         access_type="offline",
         prompt="consent",
@@ -126,20 +210,17 @@ def start_auth():
 @app.get("/auth/callback")
 async def auth_callback(request: Request, code: str = None, error: str = None, state: str = None):
     """Google redirects here after the user authorises."""
-    import asyncio
-
     if error:
         return HTMLResponse(f"<h2>Authorization failed: {error}</h2>", status_code=400)
     if not code:
         return HTMLResponse("<h2>No authorization code received.</h2>", status_code=400)
 
-    entry = _oauth_flows.pop(state, None) if state else None
-    if entry is None:
+    flow = _pop_flow(state) if state else None
+    if flow is None:
         return HTMLResponse(
             "<h2>OAuth state mismatch or expired. Please <a href='/auth/login'>try again</a>.</h2>",
             status_code=400,
         )
-    flow, _ = entry
 
     try:
         flow.fetch_token(code=code)
@@ -147,15 +228,9 @@ async def auth_callback(request: Request, code: str = None, error: str = None, s
         logger.error(f"Token fetch error: {e}")
         return HTMLResponse(f"<h2>Token exchange failed: {e}</h2>", status_code=500)
 
-    # Decode id_token to get user info — no extra HTTP call needed
+    # Decode id_token to get user info — Google's signing certs are cached by auth
     try:
-        from google.auth.transport.requests import Request as GoogleRequest
-        from google.oauth2 import id_token as google_id_token
-        id_info = google_id_token.verify_oauth2_token(
-            flow.credentials.id_token,
-            GoogleRequest(),
-            os.environ["GOOGLE_CLIENT_ID"],
-        )
+        id_info = auth.verify_id_token(flow.credentials.id_token)
         user_id = id_info["sub"]
         email = id_info["email"]
         display_name = id_info.get("name", "")
@@ -165,7 +240,7 @@ async def auth_callback(request: Request, code: str = None, error: str = None, s
 
     is_new = db.get_user(user_id) is None
     db.upsert_user(user_id, email, display_name)
-    db.save_token(user_id, auth.credentials_to_dict(flow.credentials))
+    auth.save_credentials(user_id, flow.credentials)
     if is_new:
         db.set_service_start_epoch(user_id, int(time.time()))
 
@@ -173,8 +248,9 @@ async def auth_callback(request: Request, code: str = None, error: str = None, s
 
     if is_new:
         try:
-            import background_setup
-            asyncio.create_task(background_setup.run_setup(user_id))
+            task = asyncio.create_task(background_setup.run_setup(user_id))
+            _setup_tasks.add(task)
+            task.add_done_callback(_setup_tasks.discard)
         except Exception as e:
             logger.warning(f"Could not start background setup for {user_id}: {e}")
 
@@ -184,7 +260,7 @@ async def auth_callback(request: Request, code: str = None, error: str = None, s
         create_session_token(user_id),
         httponly=True,
         samesite="lax",
-        secure=os.environ.get("APP_BASE_URL", "").startswith("https"),
+        secure=COOKIE_SECURE,
         max_age=60 * 60 * 24 * JWT_EXPIRE_DAYS,
     )
     return redirect
@@ -197,22 +273,21 @@ def logout(response: Response):
 
 
 @app.get("/auth/status")
-def auth_status(request: Request):
+async def auth_status(request: Request):
     """Backward-compat: check if the current request is authenticated."""
     token = request.cookies.get(COOKIE_NAME)
     if not token:
         return {"authorized": False}
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return {"authorized": bool(payload.get("sub"))}
-    except JWTError:
-        return {"authorized": False}
+    return {"authorized": _decode_session(token) is not None}
 
 
 # ── User info ──────────────────────────────────────────────────────────────────
 
+# List endpoints return JSONResponse directly: rows from database.py are already
+# plain JSON types, so FastAPI's recursive jsonable_encoder pass is pure overhead.
+
 @app.get("/api/me")
-def get_me(user_id: str = Depends(get_current_user)):
+def get_me(user_id: CurrentUser):
     user = db.get_user(user_id)
     if not user:
         raise HTTPException(404, "User not found")
@@ -220,8 +295,8 @@ def get_me(user_id: str = Depends(get_current_user)):
 
 
 @app.get("/api/contacts")
-def get_contacts(user_id: str = Depends(get_current_user)):
-    return db.get_contacts(user_id)
+def get_contacts(user_id: CurrentUser):
+    return JSONResponse(db.get_contacts(user_id))
 
 
 class ContactCreate(BaseModel):
@@ -238,7 +313,7 @@ class ContactUpdate(BaseModel):
 
 
 @app.post("/api/contacts")
-def add_contact(payload: ContactCreate, user_id: str = Depends(get_current_user)):
+def add_contact(payload: ContactCreate, user_id: CurrentUser):
     db.upsert_contact(
         user_id,
         email=payload.email,
@@ -250,19 +325,19 @@ def add_contact(payload: ContactCreate, user_id: str = Depends(get_current_user)
 
 
 @app.put("/api/contacts/{contact_email:path}")
-def update_contact(contact_email: str, payload: ContactUpdate, user_id: str = Depends(get_current_user)):
+def update_contact(contact_email: str, payload: ContactUpdate, user_id: CurrentUser):
     db.update_contact_details(user_id, contact_email, payload.name, payload.relationship_type, payload.formality_level)
     return {"ok": True}
 
 
 @app.delete("/api/contacts/{contact_email:path}")
-def delete_contact_endpoint(contact_email: str, user_id: str = Depends(get_current_user)):
+def delete_contact_endpoint(contact_email: str, user_id: CurrentUser):
     db.delete_contact(user_id, contact_email)
     return {"ok": True}
 
 
 @app.get("/api/profile")
-def get_profile(user_id: str = Depends(get_current_user)):
+def get_profile(user_id: CurrentUser):
     return db.load_user_params(user_id)
 
 
@@ -271,9 +346,9 @@ class ProfileUpdate(BaseModel):
 
 
 @app.put("/api/profile")
-def update_profile(payload: ProfileUpdate, user_id: str = Depends(get_current_user)):
-    current = db.load_user_params(user_id)
-    current["voice_profile"] = payload.voice_profile
+def update_profile(payload: ProfileUpdate, user_id: CurrentUser):
+    # New dict: load_user_params may hand back the shared behavior_params defaults
+    current = {**db.load_user_params(user_id), "voice_profile": payload.voice_profile}
     db.save_user_params(user_id, current)
     return {"ok": True}
 
@@ -281,7 +356,7 @@ def update_profile(payload: ProfileUpdate, user_id: str = Depends(get_current_us
 # ── Config ─────────────────────────────────────────────────────────────────────
 
 @app.get("/api/config")
-def get_config(user_id: str = Depends(get_current_user)):
+def get_config(user_id: CurrentUser):
     return db.load_user_config(user_id)
 
 
@@ -294,16 +369,29 @@ class ConfigUpdate(BaseModel):
     lookback_hours: Optional[int] = Field(None, ge=0)
     user_timezone: Optional[str] = None
     anthropic_model: Optional[str] = None
+    skip_patterns: Optional[list[str]] = Field(None, max_length=50)
 
 
 @app.patch("/api/config")
-def update_config(body: ConfigUpdate, user_id: str = Depends(get_current_user)):
+def update_config(body: ConfigUpdate, user_id: CurrentUser):
     updates = {k: v for k, v in body.model_dump().items() if v is not None}
     if not updates:
         raise HTTPException(400, "No updates provided")
+    for pattern in updates.get("skip_patterns", ()):
+        # An empty pattern would match, and so skip, every email
+        if not pattern.strip():
+            raise HTTPException(400, "Skip patterns must not be empty")
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise HTTPException(400, f"Invalid skip pattern {pattern!r}: {e}")
     current = db.load_user_config(user_id)
     merged = {**current, **updates}
     db.save_user_config(user_id, merged)
+    if any(merged[k] != current.get(k) for k in ("lookback_hours", "skip_patterns") if k in updates):
+        # Scheduled polls skip the listing while Gmail history shows no new
+        # mail; drop the stored id so the next one applies the new settings
+        db.set_history_id(user_id, None)
     if "poll_interval_minutes" in updates:
         scheduler.add_user_job(user_id)  # reschedule with new interval
     return merged
@@ -312,14 +400,19 @@ def update_config(body: ConfigUpdate, user_id: str = Depends(get_current_user)):
 # ── Queue ──────────────────────────────────────────────────────────────────────
 
 @app.get("/api/queue")
-def queue(pending_only: bool = False, user_id: str = Depends(get_current_user)):
-    if pending_only:
-        return db.get_pending_queue(user_id)
-    return db.get_all_queue(user_id)
+def queue(
+    user_id: CurrentUser,
+    pending_only: bool = False,
+    limit: int = Query(100, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
+    return JSONResponse(
+        db.get_queue_summary(user_id, pending_only=pending_only, limit=limit, offset=offset)
+    )
 
 
 @app.get("/api/queue/{item_id}")
-def queue_item(item_id: int, user_id: str = Depends(get_current_user)):
+def queue_item(item_id: int, user_id: CurrentUser):
     item = db.get_queue_item(user_id, item_id)
     if not item:
         raise HTTPException(404, "Item not found")
@@ -331,7 +424,7 @@ class DraftUpdate(BaseModel):
 
 
 @app.put("/api/queue/{item_id}/draft")
-def update_draft(item_id: int, body: DraftUpdate, user_id: str = Depends(get_current_user)):
+def update_draft(item_id: int, body: DraftUpdate, user_id: CurrentUser):
     item = db.get_queue_item(user_id, item_id)
     if not item:
         raise HTTPException(404, "Item not found")
@@ -340,75 +433,101 @@ def update_draft(item_id: int, body: DraftUpdate, user_id: str = Depends(get_cur
 
 
 class ApproveAction(BaseModel):
-    action: str  # "send", "draft", or "discard"
+    action: Literal["send", "draft", "discard"]
 
 
 @app.post("/api/queue/{item_id}/action")
-def take_action(item_id: int, body: ApproveAction, user_id: str = Depends(get_current_user)):
+def take_action(item_id: int, body: ApproveAction, user_id: CurrentUser):
     item = db.get_queue_item(user_id, item_id)
     if not item:
         raise HTTPException(404, "Item not found")
+    if item["status"] == "sending":
+        raise HTTPException(409, "Item is already being sent")
     if item["status"] != "pending":
         raise HTTPException(400, f"Item already actioned: {item['status']}")
 
     sender_email = _extract_email(item["sender"])
     subject = item["subject"]
-    reply_subject = subject if subject.lower().startswith("re:") else f"Re: {subject}"
+    reply_subject = subject if subject[:3].lower() == "re:" else f"Re: {subject}"
 
-    # Re-fetch Drive attachment if needed (binary data is not persisted to DB)
-    attachments = []
-    cls = item.get("classification") or {}
-    if cls.get("needs_gdrive") and cls.get("gdrive_query"):
-        drive_service = auth.get_drive_service(user_id)
-        attachments = search_and_attach(drive_service, cls["gdrive_query"])
-
-    if body.action == "send":
-        gmail_service = auth.get_gmail_service(user_id)
-        success = send_reply(
-            gmail_service,
-            thread_id=item["thread_id"],
-            to=sender_email,
-            subject=reply_subject,
-            body=item["draft_reply"],
-            attachments=attachments or None,
-        )
-        if not success:
-            raise HTTPException(500, "Failed to send email")
-        db.update_queue_item(user_id, item_id, "sent", "sent by user")
-        db.log_event(user_id, "user_sent", f"Sent: '{subject}' → {sender_email}")
-
-    elif body.action == "draft":
-        gmail_service = auth.get_gmail_service(user_id)
-        create_reply_draft(
-            gmail_service,
-            thread_id=item["thread_id"],
-            to=sender_email,
-            subject=reply_subject,
-            body=item["draft_reply"],
-            attachments=attachments or None,
+    if body.action == "discard":
+        resolved = db.resolve_queue_item(
+            user_id, item_id, "discarded", "discarded by user",
+            "user_discarded", f"Discarded: '{subject}'",
         )
-        db.update_queue_item(user_id, item_id, "drafted", "saved as Gmail draft")
-        db.log_event(user_id, "user_drafted", f"Saved to drafts: '{subject}'")
+    else:
+        # Claim the item before any Gmail call, so two concurrent requests
+        # can't both send it
+        if not db.claim_queue_item(user_id, item_id):
+            raise HTTPException(409, "Item already actioned")
+        try:
+            ok = _send_or_draft(item, body.action, user_id, sender_email, reply_subject)
+        except Exception:
+            db.release_queue_item(user_id, item_id)
+            raise
+        if not ok:
+            db.release_queue_item(user_id, item_id)
+            raise HTTPException(500, "Failed to send email" if body.action == "send" else "Failed to create draft")
+        if body.action == "send":
+            resolved = db.resolve_queue_item(
+                user_id, item_id, "sent", "sent by user",
+                "user_sent", f"Sent: '{subject}' → {sender_email}", from_status="sending",
+            )
+        else:
+            resolved = db.resolve_queue_item(
+                user_id, item_id, "drafted", "saved as Gmail draft",
+                "user_drafted", f"Saved to drafts: '{subject}'", from_status="sending",
+            )
+
+    if not resolved:
+        # Another request actioned the item between our read and write
+        raise HTTPException(409, "Item already actioned")
+    return {"ok": True, "action": body.action}
 
-    elif body.action == "discard":
-        db.update_queue_item(user_id, item_id, "discarded", "discarded by user")
-        db.log_event(user_id, "user_discarded", f"Discarded: '{subject}'")
 
-    else:
-        raise HTTPException(400, f"Unknown action: {body.action}")
+def _send_or_draft(item: dict, action: str, user_id: str, to: str, subject: str) -> bool:
+    """Send the item's draft or save it as a Gmail draft. Returns success."""
+    # Re-fetch Drive attachment if needed (binary data is not persisted to DB),
+    # on a worker thread while this one gets the Gmail client ready. Items
+    # record the chosen file, so only older ones need to search again.
+    drive_future = None
+    cls = item.get("classification") or {}
+    if cls.get("drive_files"):
+        drive_future = _action_pool.submit(_download_attachments, user_id, cls["drive_files"])
+    elif cls.get("needs_gdrive") and cls.get("gdrive_query"):
+        drive_future = _action_pool.submit(_fetch_attachments, user_id, cls["gdrive_query"])
+    gmail_service = auth.get_gmail_service(user_id)
+    attachments = drive_future.result() if drive_future else []
+
+    reply = dict(
+        thread_id=item["thread_id"],
+        to=to,
+        subject=subject,
+        body=item["draft_reply"],
+        attachments=attachments or None,
+    )
+    if action == "send":
+        return send_reply(gmail_service, **reply)
+    return create_reply_draft(gmail_service, **reply) is not None
 
-    return {"ok": True, "action": body.action}
+
+def _fetch_attachments(user_id: str, query: str) -> list[dict]:
+    return search_and_attach(auth.get_drive_service(user_id), query, user_id=user_id)
+
+
+def _download_attachments(user_id: str, files: list[dict]) -> list[dict]:
+    return download_files(auth.get_drive_service(user_id), files, user_id=user_id)
 
 
 # ── Scheduler ──────────────────────────────────────────────────────────────────
 
 @app.get("/api/scheduler/status")
-def scheduler_status(user_id: str = Depends(get_current_user)):
+def scheduler_status(user_id: CurrentUser):
     return scheduler.get_user_status(user_id)
 
 
 @app.post("/api/scheduler/run-now")
-def trigger_poll(user_id: str = Depends(get_current_user)):
+def trigger_poll(user_id: CurrentUser):
     results = scheduler.run_now(user_id)
     return {"processed": len(results), "results": results}
 
@@ -417,14 +536,17 @@ def trigger_poll(user_id: str = Depends(get_current_user)):
 
 @app.get("/api/events")
 def get_events(
+    user_id: CurrentUser,
     limit: int = Query(50, ge=1, le=200),
-    user_id: str = Depends(get_current_user),
 ):
-    return db.get_recent_events(user_id, limit)
+    return JSONResponse(db.get_recent_events(user_id, limit))
 
 
 # ── Helpers ────────────────────────────────────────────────────────────────────
 
+_EMAIL_RE = re.compile(r"<([^>]+)>")
+
+
 def _extract_email(sender: str) -> str:
-    match = re.search(r"<([^>]+)>", sender)
+    match = _EMAIL_RE.search(sender)
     return match.group(1) if match else sender
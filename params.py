@@ -9,9 +9,21 @@ from pathlib import Path
 
 PARAMS_FILE = Path("behavior_params.json")
 
+# (mtime of PARAMS_FILE or None if missing, parsed params) — re-read only when the file changes
+_cached: tuple = None
+
 
 def load_params() -> dict:
-    if PARAMS_FILE.exists():
-        with open(PARAMS_FILE) as f:
-            return json.load(f)
-    return {}
+    """
+    The parsed params file. The dict is shared between callers, so treat it
+    as read-only; copy before modifying.
+    """
+    global _cached
+    mtime = PARAMS_FILE.stat().st_mtime if PARAMS_FILE.exists() else None
+    if _cached is None or _cached[0] != mtime:
+        if mtime is not None:
+            with open(PARAMS_FILE) as f:
+                _cached = (mtime, json.load(f))
+        else:
+            _cached = (None, {})
+    return _cached[1]
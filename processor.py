@@ -9,6 +9,9 @@ Core processor: orchestrates the full pipeline for each new email.
 """
 
 import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import auth
@@ -22,19 +25,84 @@ from gmail_client import create_reply_draft, mark_as_read, send_reply
 
 logger = logging.getLogger(__name__)
 
+# Drive fetches overlapped with the calendar lookup. Separate from the
+# scheduler's email pool, whose workers block on these futures.
+_context_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="context")
 
-def process_email(email: dict, user_id: str) -> dict:
+# (user_id, message_id) pairs some thread is processing right now
+_in_flight: set[tuple[str, str]] = set()
+_in_flight_lock = threading.Lock()
+
+
+def process_email(
+    email: dict,
+    user_id: str,
+    processed_batch: Optional[list] = None,
+    config: Optional[dict] = None,
+    params: Optional[dict] = None,
+) -> dict:
     """
     Full pipeline for a single email belonging to user_id.
     Returns a result dict with action taken.
+
+    If processed_batch is given, emails that end without any Gmail side
+    effect (skipped, draft failed) are appended to it as (message_id,
+    thread_id) for the caller to mark in bulk, then pass to release_claims;
+    sent/queued emails are always marked immediately.
+
+    config/params may be pre-loaded by the caller once per poll; they are
+    read from the DB when omitted.
     """
-    config = db.load_user_config(user_id)
-    params = db.load_user_params(user_id)
-    model = config["anthropic_model"]
+    if config is None:
+        config = db.load_user_config(user_id)
+    if params is None:
+        params = db.load_user_params(user_id)
     message_id = email["id"]
 
-    if db.is_processed(user_id, message_id):
-        return {"message_id": message_id, "action": "skipped", "reason": "already processed"}
+    # A scheduled poll and a manual run-now can overlap; only one of them may
+    # work on a given message, or it could be replied to twice
+    key = (user_id, message_id)
+    with _in_flight_lock:
+        if key in _in_flight:
+            return {"message_id": message_id, "action": "skipped", "reason": "already in progress"}
+        _in_flight.add(key)
+
+    # Checked under the claim: a poll that held it before us may have just
+    # finished this message
+    deferred = False
+    try:
+        if db.is_processed(user_id, message_id):
+            return {"message_id": message_id, "action": "skipped", "reason": "already processed"}
+        result = _run_pipeline(email, user_id, processed_batch, config, params)
+        # Deferred marks aren't written until the caller's bulk insert; the
+        # claim stays held until then (see release_claims)
+        deferred = processed_batch is not None and (message_id, email["thread_id"]) in processed_batch
+        return result
+    finally:
+        if not deferred:
+            release_claims(user_id, [message_id])
+
+
+def release_claims(user_id: str, message_ids) -> None:
+    """
+    Drop in-flight claims. process_email keeps the claim on emails it left
+    in processed_batch; the caller releases them once they're marked.
+    """
+    with _in_flight_lock:
+        for message_id in message_ids:
+            _in_flight.discard((user_id, message_id))
+
+
+def _run_pipeline(
+    email: dict,
+    user_id: str,
+    processed_batch: Optional[list],
+    config: dict,
+    params: dict,
+) -> dict:
+    """Steps 1-6 for an email this thread has claimed."""
+    model = config["anthropic_model"]
+    message_id = email["id"]
 
     logger.info(f"[{user_id}] Processing: [{email['subject']}] from {email['sender']}")
 
@@ -51,6 +119,9 @@ def process_email(email: dict, user_id: str) -> dict:
         subject=email["subject"],
         body=email["body"],
         has_attachments=email["has_attachments"],
+        auto_submitted=email.get("auto_submitted", False),
+        skip_patterns=config.get("skip_patterns"),
+        list_mail=email.get("list_mail", False),
         params=params,
         model=model,
         contact=contact,
@@ -71,17 +142,27 @@ def process_email(email: dict, user_id: str) -> dict:
 
     priority = classification.get("sender_priority", "unknown")
     confidence_pct = round(classification.get("confidence", 0) * 100)
-    db.log_event(
-        user_id,
-        "classified",
-        f"'{email['subject']}' from {_sender_name(email['sender'])} "
-        f"— {priority} priority, {confidence_pct}% confidence",
-    )
+    if classification.get("fast_path"):
+        # Its own event type, so the share of mail skipped without a Claude
+        # call shows in the activity log
+        db.log_event(
+            user_id,
+            "fast_path",
+            f"'{email['subject']}' from {_sender_name(email['sender'])} "
+            f"— {classification['reasoning']}",
+        )
+    else:
+        db.log_event(
+            user_id,
+            "classified",
+            f"'{email['subject']}' from {_sender_name(email['sender'])} "
+            f"— {priority} priority, {confidence_pct}% confidence",
+        )
 
     # Step 2: Skip if no reply needed
     if not classification.get("needs_reply"):
         db.log_event(user_id, "skipped", f"'{email['subject']}' — no reply needed")
-        db.mark_processed(user_id, message_id, email["thread_id"])
+        _mark_processed_deferred(user_id, email, processed_batch)
         return {"message_id": message_id, "action": "skipped", "reason": "no reply needed"}
 
     # Step 3: Gather context
@@ -89,6 +170,13 @@ def process_email(email: dict, user_id: str) -> dict:
     attachment_names: list[str] = []
     attachments: list[dict] = []
 
+    # Drive search + download runs on a worker thread while this one checks the
+    # calendar; the two are independent round trips
+    drive_future = None
+    if classification.get("needs_gdrive") and classification.get("gdrive_query"):
+        query = classification["gdrive_query"]
+        drive_future = _context_pool.submit(_fetch_attachments, user_id, query)
+
     if classification.get("needs_calendar"):
         days = int(classification.get("calendar_days_requested") or 7)
         days = max(1, min(days, 60))
@@ -97,14 +185,13 @@ def process_email(email: dict, user_id: str) -> dict:
             cal_service,
             days_ahead=days,
             tz_name=config.get("user_timezone", "America/Chicago"),
+            user_id=user_id,
         )
         logger.info(f"  Calendar slots ({days}d): {repr(calendar_slots)}")
         db.log_event(user_id, "calendar_checked", f"Checked calendar availability ({days}d window)")
 
-    if classification.get("needs_gdrive") and classification.get("gdrive_query"):
-        query = classification["gdrive_query"]
-        drive_service = auth.get_drive_service(user_id)
-        attachments = search_and_attach(drive_service, query)
+    if drive_future is not None:
+        attachments = drive_future.result()
         attachment_names = [a["filename"] for a in attachments]
         logger.info(f"  Drive attachments: {attachment_names}")
         if attachment_names:
@@ -128,7 +215,7 @@ def process_email(email: dict, user_id: str) -> dict:
     )
 
     if not draft_body:
-        db.mark_processed(user_id, message_id, email["thread_id"])
+        _mark_processed_deferred(user_id, email, processed_batch)
         return {"message_id": message_id, "action": "error", "reason": "draft generation failed"}
 
     # Step 5: Route
@@ -144,7 +231,7 @@ def process_email(email: dict, user_id: str) -> dict:
     # Step 6: Execute decision
     reply_subject = (
         email["subject"]
-        if email["subject"].lower().startswith("re:")
+        if email["subject"][:3].lower() == "re:"
         else f"Re: {email['subject']}"
     )
     sender_email = _extract_email(email["sender"])
@@ -181,6 +268,8 @@ def process_email(email: dict, user_id: str) -> dict:
                 "routing_reason": decision.reason,
                 "has_attachments": has_attachments_to_send,
                 "attachment_names": attachment_names,
+                # Lets take_action download the same files without searching again
+                "drive_files": [a["drive_file"] for a in attachments if a.get("drive_file")],
             },
         )
 
@@ -196,15 +285,30 @@ def process_email(email: dict, user_id: str) -> dict:
     }
 
 
+def _mark_processed_deferred(user_id: str, email: dict, processed_batch: Optional[list]) -> None:
+    """Queue a side-effect-free mark for bulk insert, or write it now if no batch."""
+    if processed_batch is None:
+        db.mark_processed(user_id, email["id"], email["thread_id"])
+    else:
+        processed_batch.append((email["id"], email["thread_id"]))
+
+
+def _fetch_attachments(user_id: str, query: str) -> list[dict]:
+    # Built on the worker thread: API clients are per-thread (auth._get_service)
+    return search_and_attach(auth.get_drive_service(user_id), query, user_id=user_id)
+
+
+_EMAIL_RE = re.compile(r"<([^>]+)>")
+_NAME_RE = re.compile(r"^([^<]+)<")
+
+
 def _extract_email(sender: str) -> str:
     """Extract bare email from 'Name <email>' format."""
-    import re
-    match = re.search(r"<([^>]+)>", sender)
+    match = _EMAIL_RE.search(sender)
     return match.group(1) if match else sender
 
 
 def _sender_name(sender: str) -> str:
     """Extract display name from 'Name <email>' format, fall back to email."""
-    import re
-    match = re.match(r"^([^<]+)<", sender)
+    match = _NAME_RE.match(sender)
     return match.group(1).strip() if match else sender.split("@")[0]
@@ -4,24 +4,50 @@ Each authenticated user gets their own APScheduler job keyed by user_id.
 """
 
 import logging
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from typing import Iterable, Optional
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
 import auth
 import database as db
-from gmail_client import fetch_unread_emails
-from processor import process_email
+from gmail_client import fetch_unread_emails, get_history_id, inbox_changed_since, list_unread_threads
+from processor import process_email, release_claims
 
 logger = logging.getLogger(__name__)
 
 _scheduler: BackgroundScheduler = None
 
-# Per-user state
+# Emails within a poll are processed concurrently so their Claude/Gmail round
+# trips overlap. Long-lived so each worker keeps its thread-local DB
+# connection and Google API clients warm across polls.
+EMAIL_WORKERS = 4
+_email_pool = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix="email")
+
+# Per-user state, written by poll threads and read by API threads; the lock
+# keeps a user's last_run and results from two different polls
 _last_run: dict[str, str] = {}      # user_id -> ISO timestamp string
 _last_results: dict[str, list] = {} # user_id -> results list
+_state_lock = threading.Lock()
+
+
+# Upper bound on the random delay added to each user's poll
+POLL_JITTER_SECONDS = 60
+
+# Job id for periodic SQLite maintenance (user jobs are keyed by user_id)
+MAINTENANCE_JOB_ID = "db_maintenance"
+MAINTENANCE_INTERVAL_MINUTES = 15
+
+# Refresh tokens expiring within TOKEN_REFRESH_MARGIN_SECONDS every minute,
+# so the token refresh round trip happens here rather than inside a poll or
+# a user's queue action
+TOKEN_REFRESH_JOB_ID = "token_refresh"
+TOKEN_REFRESH_MARGIN_SECONDS = 300
 
 
 def init_scheduler():
@@ -29,27 +55,64 @@ def init_scheduler():
     if _scheduler is None or not _scheduler.running:
         _scheduler = BackgroundScheduler()
         _scheduler.start()
+        _scheduler.add_job(
+            func=_run_maintenance,
+            trigger=IntervalTrigger(minutes=MAINTENANCE_INTERVAL_MINUTES),
+            id=MAINTENANCE_JOB_ID,
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+        )
+        _scheduler.add_job(
+            func=_refresh_tokens,
+            trigger=IntervalTrigger(minutes=1),
+            id=TOKEN_REFRESH_JOB_ID,
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+        )
         logger.info("Scheduler started.")
 
 
+def _run_maintenance() -> None:
+    try:
+        db.run_maintenance()
+    except Exception as e:
+        logger.error(f"DB maintenance failed: {e}")
+
+
+def _refresh_tokens() -> None:
+    for uid in db.get_all_users_with_tokens():
+        try:
+            if auth.refresh_if_expiring(uid, TOKEN_REFRESH_MARGIN_SECONDS):
+                logger.info(f"[{uid}] Token refreshed ahead of expiry")
+        except Exception as e:
+            # get_credentials surfaces this on the next real use
+            logger.warning(f"[{uid}] Background token refresh failed: {e}")
+
+
 def shutdown_scheduler():
     global _scheduler
     if _scheduler and _scheduler.running:
         _scheduler.shutdown(wait=False)
         logger.info("Scheduler shut down.")
+    _email_pool.shutdown(wait=False, cancel_futures=True)
 
 
-def add_user_job(user_id: str) -> None:
-    """Add or replace the polling job for a user."""
+def add_user_job(user_id: str, config: Optional[dict] = None) -> None:
+    """Add or replace the polling job for a user. config: already-loaded user config."""
     global _scheduler
     if _scheduler is None or not _scheduler.running:
         init_scheduler()
 
-    config = db.load_user_config(user_id)
+    if config is None:
+        config = db.load_user_config(user_id)
     interval = config.get("poll_interval_minutes", 30)
     _scheduler.add_job(
         func=_run_for_user,
-        trigger=IntervalTrigger(minutes=interval),
+        # Jitter spreads users re-added together at startup across the interval
+        # edge instead of hitting Gmail and Anthropic in the same second
+        trigger=IntervalTrigger(minutes=interval, jitter=min(POLL_JITTER_SECONDS, interval * 15)),
         id=user_id,
         args=[user_id],
         replace_existing=True,
@@ -59,6 +122,15 @@ def add_user_job(user_id: str) -> None:
     logger.info(f"[{user_id}] Scheduler job added/updated: every {interval}min")
 
 
+def add_all_user_jobs() -> None:
+    """Startup: schedule every user with a stored token, loading their configs in one query."""
+    for uid, config in db.load_configs_for_token_users().items():
+        try:
+            add_user_job(uid, config)
+        except Exception as e:
+            logger.warning(f"Could not re-add job for {uid}: {e}")
+
+
 def remove_user_job(user_id: str) -> None:
     """Remove a user's polling job (e.g. on token revocation)."""
     global _scheduler
@@ -68,111 +140,148 @@ def remove_user_job(user_id: str) -> None:
 
 
 def _run_for_user(user_id: str) -> None:
-    """Core poll logic for a single user."""
+    """Scheduled poll for a single user; respects the user's poll window."""
+    _poll(user_id, manual=False)
+
+
+def _poll(user_id: str, manual: bool) -> Optional[list]:
+    """
+    Core poll logic for a single user. manual=True (run-now) skips the
+    hour-window check. Returns this poll's results, or None if it didn't run.
+    """
     # Verify token is still valid before proceeding
     try:
         auth.get_credentials(user_id)
     except ValueError:
-        db.log_event(user_id, "error", "No valid token — skipping poll")
-        return
+        db.log_event(user_id, "error", "No valid token — " + ("cannot run now" if manual else "skipping poll"))
+        return None
 
     config = db.load_user_config(user_id)
-    hour = datetime.now().hour
-    if not (config["poll_start_hour"] <= hour <= config["poll_end_hour"]):
-        logger.info(f"[{user_id}] Outside poll window ({hour}:00). Skipping.")
-        return
+    if not manual:
+        hour = time.localtime().tm_hour
+        if not (config["poll_start_hour"] <= hour <= config["poll_end_hour"]):
+            logger.info(f"[{user_id}] Outside poll window ({hour}:00). Skipping.")
+            return None
+
+    gmail_service = auth.get_gmail_service(user_id)
+
+    # Scheduled polls first ask Gmail whether anything reached the inbox since
+    # the last complete poll; an idle mailbox then costs one history call
+    # instead of a full unread listing. Run-now always does the full listing.
+    last_history_id = None if manual else db.get_history_id(user_id)
+    if last_history_id and inbox_changed_since(gmail_service, last_history_id) is False:
+        logger.info(f"[{user_id}] No new mail since last poll. Skipping.")
+        with _state_lock:
+            _last_run[user_id] = datetime.now(timezone.utc).isoformat()
+            _last_results[user_id] = []
+        return []
 
-    user = db.get_user(user_id)
     lookback = config.get("lookback_hours", 72)
     if lookback > 0:
         epoch_filter = int(time.time()) - lookback * 3600
     else:
         # 0 = use service_start_epoch as lower bound (don't go before first login)
+        user = db.get_user(user_id)
         epoch_filter = user.get("service_start_epoch") if user else None
 
-    logger.info(f"[{user_id}] Polling Gmail (lookback={lookback}h)...")
-    db.log_event(user_id, "poll_start", f"Scanning Gmail (past {lookback}h)...")
-
-    gmail_service = auth.get_gmail_service(user_id)
-    emails = fetch_unread_emails(gmail_service, max_results=50, after_epoch=epoch_filter)
-
-    results = []
-    for email in emails:
-        try:
-            result = process_email(email, user_id=user_id)
-            results.append(result)
-            logger.info(f"  [{user_id}] -> {result['action']}: {result.get('subject', '')}")
-        except Exception as e:
-            logger.error(f"  [{user_id}] Error processing {email.get('id')}: {e}")
-
-    _last_run[user_id] = datetime.now(timezone.utc).isoformat()
-    _last_results[user_id] = results
+    logger.info(f"[{user_id}] Polling Gmail (lookback={lookback}h{', manual' if manual else ''})...")
+    scan = "Manual scan" if manual else "Scanning Gmail"
+    db.log_event(user_id, "poll_start", f"{scan} (past {lookback}h)...")
 
-    counts = {}
-    for r in results:
-        counts[r["action"]] = counts.get(r["action"], 0) + 1
+    # Read before listing, so mail arriving mid-poll shows up in the next check
+    history_id = get_history_id(gmail_service)
+    try:
+        thread_ids, truncated = list_unread_threads(gmail_service, max_results=50, after_epoch=epoch_filter)
+    except Exception as e:
+        logger.error(f"[{user_id}] Error listing emails: {e}")
+        thread_ids, truncated, history_id = [], False, None
+
+    # Loaded once per poll and shared by every email in the batch
+    params = db.load_user_params(user_id)
+    emails = fetch_unread_emails(gmail_service, thread_ids)
+    results, scanned, complete = _process_emails(user_id, emails, config, params)
+    if truncated:
+        # Unread mail past the listing limit wasn't seen; without a stored id
+        # the next poll lists in full instead of waiting for new mail
+        db.set_history_id(user_id, None)
+    elif history_id and complete:
+        # After a failed fetch or an email that raised, the old historyId
+        # stays, so the next poll lists again and retries
+        db.set_history_id(user_id, history_id)
+    for result in results:
+        logger.info(f"  [{user_id}] -> {result['action']}: {result.get('subject', '')}")
+
+    with _state_lock:
+        _last_run[user_id] = datetime.now(timezone.utc).isoformat()
+        _last_results[user_id] = results
+
+    counts = Counter(r["action"] for r in results)
     summary = (
-        f"Scanned {len(emails)} email(s) — "
+        f"Scanned {scanned} email(s) — "
         f"{counts.get('review', 0)} queued, "
         f"{counts.get('sent', 0)} sent, "
         f"{counts.get('skipped', 0)} skipped"
     )
     db.log_event(user_id, "poll_end", summary)
     logger.info(f"[{user_id}] Poll complete. {summary}")
-
-
-def run_now(user_id: str) -> list:
-    """Trigger an immediate poll for a user, bypassing the time window."""
-    _run_for_user_force(user_id)
-    return _last_results.get(user_id, [])
-
-
-def _run_for_user_force(user_id: str) -> None:
-    """Same as _run_for_user but skips the hour-window check."""
+    return results
+
+
+def _process_emails(
+    user_id: str, emails: Iterable[dict], config: dict, params: dict,
+) -> tuple[list, int, bool]:
+    """
+    Run process_email over a poll's emails on the worker pool; results keep
+    fetch order. Each email is submitted as soon as the fetch yields it, so
+    the first batch is being processed while later batches download.
+    Returns (results, emails scanned, whether the fetch and every email
+    finished without raising).
+    """
+    processed_batch: list[tuple[str, str]] = []
+    # Only the id is kept here; the email dict is released once its task runs
+    futures = []
+    complete = True
     try:
-        auth.get_credentials(user_id)
-    except ValueError:
-        db.log_event(user_id, "error", "No valid token — cannot run now")
-        return
-
-    config = db.load_user_config(user_id)
-    user = db.get_user(user_id)
-    lookback = config.get("lookback_hours", 72)
-    if lookback > 0:
-        epoch_filter = int(time.time()) - lookback * 3600
-    else:
-        epoch_filter = user.get("service_start_epoch") if user else None
-
-    db.log_event(user_id, "poll_start", f"Manual scan (past {lookback}h)...")
-    gmail_service = auth.get_gmail_service(user_id)
-    emails = fetch_unread_emails(gmail_service, max_results=50, after_epoch=epoch_filter)
+        for email in emails:
+            futures.append((email["id"], _email_pool.submit(
+                process_email, email, user_id=user_id, processed_batch=processed_batch,
+                config=config, params=params,
+            )))
+    except Exception as e:
+        # Emails already submitted still finish and get recorded below
+        logger.error(f"[{user_id}] Error fetching emails: {e}")
+        complete = False
 
     results = []
-    for email in emails:
+    for message_id, future in futures:
         try:
-            result = process_email(email, user_id=user_id)
-            results.append(result)
+            results.append(future.result())
         except Exception as e:
-            logger.error(f"  [{user_id}] Error processing {email.get('id')}: {e}")
+            logger.error(f"  [{user_id}] Error processing {message_id}: {e}")
+            complete = False
+    try:
+        db.mark_processed_bulk(user_id, processed_batch)
+    finally:
+        # process_email held these claims until they were marked
+        release_claims(user_id, [message_id for message_id, _ in processed_batch])
+    return results, len(futures), complete
 
-    _last_run[user_id] = datetime.now(timezone.utc).isoformat()
-    _last_results[user_id] = results
 
-    counts = {}
-    for r in results:
-        counts[r["action"]] = counts.get(r["action"], 0) + 1
-    summary = (
-        f"Scanned {len(emails)} email(s) — "
-        f"{counts.get('review', 0)} queued, "
-        f"{counts.get('sent', 0)} sent, "
-        f"{counts.get('skipped', 0)} skipped"
-    )
-    db.log_event(user_id, "poll_end", summary)
+def run_now(user_id: str) -> list:
+    """Trigger an immediate poll for a user, bypassing the time window."""
+    results = _poll(user_id, manual=True)
+    if results is not None:
+        return results
+    with _state_lock:
+        return _last_results.get(user_id, [])
 
 
 def get_user_status(user_id: str) -> dict:
     global _scheduler
     config = db.load_user_config(user_id)
+    with _state_lock:
+        last_run = _last_run.get(user_id)
+        last_count = len(_last_results.get(user_id, []))
     job_running = (
         _scheduler is not None
         and _scheduler.running
@@ -183,6 +292,6 @@ def get_user_status(user_id: str) -> dict:
         "poll_interval_minutes": config["poll_interval_minutes"],
         "poll_start_hour": config["poll_start_hour"],
         "poll_end_hour": config["poll_end_hour"],
-        "last_run": _last_run.get(user_id),
-        "last_results_count": len(_last_results.get(user_id, [])),
+        "last_run": last_run,
+        "last_results_count": last_count,
     }